@@ -8,13 +8,17 @@ primarily with communication to/from the API's users."""
 import logging
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 
 from models import User, Game, Score
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
     ScoreForms
-from utils import get_by_urlsafe
+from utils import get_by_urlsafe, get_key_by_urlsafe, fetch_page_async,\
+    run_in_transaction
+from counters import update_active_games, get_active_games
+import stats
+from stats import instrumented
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -24,8 +28,8 @@ MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
-
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+PAGE_REQUEST = endpoints.ResourceContainer(page_size=messages.IntegerField(1),
+                                           cursor=messages.StringField(2))
 
 @endpoints.api(name='guess_a_number', version='v1')
 class GuessANumberApi(remote.Service):
@@ -35,13 +39,18 @@ class GuessANumberApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
-        """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        """Create a User. Requires a unique username and email"""
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user name is required!')
+        if User.get_by_name(request.user_name):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        try:
+            User.create(request.user_name, request.email)
+        except ValueError, e:
+            raise endpoints.ConflictException(str(e))
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -50,23 +59,20 @@ class GuessANumberApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         try:
             game = Game.new_game(user.key, request.min,
                                  request.max, request.attempts)
-        except ValueError:
-            raise endpoints.BadRequestException('Maximum must be greater '
-                                                'than minimum!')
-
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
+        except ValueError, e:
+            raise endpoints.BadRequestException(str(e))
+
+        update_active_games(1, game.attempts_remaining)
         return game.to_form('Good luck playing Guess a Number!')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -74,6 +80,7 @@ class GuessANumberApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
         """Return the current game state."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -87,70 +94,121 @@ class GuessANumberApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
-        """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_form('Game already over!')
-
-        game.attempts_remaining -= 1
-        if request.guess == game.target:
-            game.end_game(True)
-            return game.to_form('You win!')
-
-        if request.guess < game.target:
-            msg = 'Too low!'
-        else:
-            msg = 'Too high!'
-
-        if game.attempts_remaining < 1:
-            game.end_game(False)
-            return game.to_form(msg + ' Game over!')
-        else:
-            game.put()
-            return game.to_form(msg)
-
-    @endpoints.method(response_message=ScoreForms,
+        """Makes a move. Returns a game state with message. The Game is read
+        and written in one transaction, retried if it collides with another
+        move. A move_id seen in one of the Game's recent moves gets the
+        original reply without moving again"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+
+        def move():
+            # Returns the game, the message and the changes to the active
+            # game counters
+            game = game_key.get()
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            reply = request.move_id and game.find_move(request.move_id)
+            if reply:
+                stats.count('duplicate_moves')
+                return game, reply, (0, 0)
+            if game.game_over:
+                return game, 'Game already over!', (0, 0)
+
+            game.attempts_remaining -= 1
+            won = request.guess == game.target
+            if won:
+                msg, counts = 'You win!', (-1, -(game.attempts_remaining + 1))
+            else:
+                if request.guess < game.target:
+                    msg = 'Too low!'
+                else:
+                    msg = 'Too high!'
+                if game.attempts_remaining < 1:
+                    msg, counts = msg + ' Game over!', (-1, -1)
+                else:
+                    counts = (0, -1)
+
+            if request.move_id:
+                game.remember_move(request.move_id, msg)
+            if won or game.attempts_remaining < 1:
+                game.end_game(won)
+            else:
+                game.put()
+            return game, msg, counts
+
+        # The Game and its Score are separate entity groups
+        try:
+            game, msg, counts = run_in_transaction(move, xg=True)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException('The game is busy. Try again.')
+        if counts != (0, 0):
+            update_active_games(*counts)
+        return game.to_form(msg)
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores, newest first"""
+        return self._get_scores_page(request).get_result()
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
         """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return self._get_user_scores(request.user_name).get_result()
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        """Get the average moves remaining from the sharded counters"""
+        games, attempts = get_active_games()
+        if games < 1:
+            return StringMessage(message='')
+        average = float(attempts) / games
+        return StringMessage(
+            message='The average moves remaining is {:.2f}'.format(average))
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_scores_page(request):
+        """Fetches a page of scores and then all of their users at once"""
+        scores, cursor, more = yield fetch_page_async(
+            Score.query().order(-Score.date), request.page_size,
+            request.cursor)
+        forms = yield Score.to_forms_async(scores)
+        forms.next_cursor, forms.more = cursor, more
+        raise ndb.Return(forms)
 
     @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+    @ndb.tasklet
+    def _get_user_scores(user_name):
+        """Fetches the Scores of the User keyed by a name while the User is
+        looked up. They are only fetched again for a User created before
+        names became keys and not yet migrated."""
+        user_key = User.key_for(user_name)
+        scores_future = Score.query(Score.user == user_key).fetch_async()
+        user = yield User.get_by_name_async(user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        if user.key != user_key:
+            scores = yield Score.query(Score.user == user.key).fetch_async()
+        else:
+            scores = yield scores_future
+        raise ndb.Return(ScoreForms(items=[score.to_form(user.name)
+                                           for score in scores]))
 
 
 api = endpoints.api_server([GuessANumberApi])
@@ -0,0 +1,73 @@
+"""counters.py - Sharded running totals of the active games and their
+attempts remaining."""
+
+import logging
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+MEMCACHE_ACTIVE_GAMES = 'ACTIVE_GAMES'
+MEMCACHE_TIMEOUT = 60
+
+
+class ActiveGamesShard(ndb.Model):
+    """One shard of the count of active games and their total attempts
+    remaining. Spreading updates over shards avoids write contention"""
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    attempts = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_keys():
+    return [ndb.Key(ActiveGamesShard, str(index))
+            for index in range(NUM_SHARDS)]
+
+
+@ndb.transactional
+def _add_to_shard(key, games, attempts):
+    shard = key.get() or ActiveGamesShard(key=key)
+    shard.games += games
+    shard.attempts += attempts
+    shard.put()
+
+
+def _random_shard_key():
+    return ndb.Key(ActiveGamesShard,
+                   str(random.randint(0, NUM_SHARDS - 1)))
+
+
+def update_active_games(games, attempts):
+    """Adds to the running totals of active games and attempts remaining in
+    a random shard. Must be called outside of any transaction, after the
+    change to the games has been committed. A failed update is logged for
+    the reconciliation to correct, so it never fails the move that made the
+    change"""
+    if not games and not attempts:
+        return
+    try:
+        _add_to_shard(_random_shard_key(), games, attempts)
+    except Exception:
+        logging.exception('Could not add %d games and %d attempts to the '
+                          'counters', games, attempts)
+
+
+def get_active_games():
+    """Returns the number of active games and their total attempts
+    remaining, summed over every shard and cached briefly in memcache"""
+    totals = memcache.get(MEMCACHE_ACTIVE_GAMES)
+    if totals is None:
+        shards = [shard for shard in ndb.get_multi(_shard_keys()) if shard]
+        totals = (sum(shard.games for shard in shards),
+                  sum(shard.attempts for shard in shards))
+        memcache.set(MEMCACHE_ACTIVE_GAMES, totals, time=MEMCACHE_TIMEOUT)
+    return totals
+
+
+def reconcile_active_games(games, attempts):
+    """Corrects any drift in the counters given the true totals found by
+    scanning the active games"""
+    shards = [shard for shard in ndb.get_multi(_shard_keys()) if shard]
+    _add_to_shard(_random_shard_key(),
+                  games - sum(shard.games for shard in shards),
+                  attempts - sum(shard.attempts for shard in shards))
+    memcache.delete(MEMCACHE_ACTIVE_GAMES)
@@ -2,16 +2,26 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import GuessANumberApi
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from models import User
+import api  # registers the endpoint names reported by /admin/stats
+import stats
+from counters import reconcile_active_games
+from models import User, UserEmail, Game, Score, Migration, USER_MIGRATION
+from utils import run_in_transaction
+
+RECONCILE_BATCH_SIZE = 500
+MIGRATE_BATCH_SIZE = 100
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @stats.instrumented('send_reminder')
     def get(self):
         """Send a reminder email to each User with an email about games.
         Called every hour using a cron job"""
@@ -28,14 +38,119 @@ class SendReminderEmail(webapp2.RequestHandler):
                            body)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class ReconcileActiveGames(webapp2.RequestHandler):
+    @stats.instrumented('reconcile_active_games_cron')
+    def get(self):
+        """Start recounting the active games. Called every 6 hours using a
+        cron job"""
+        taskqueue.add(url='/tasks/reconcile_active_games')
+
+    @stats.instrumented('reconcile_active_games')
+    def post(self):
+        """Add one batch of active games to the running totals, then queue
+        the next batch. After the last batch, correct any drift in the
+        sharded active game counters"""
+        cursor = self.request.get('cursor')
+        games = int(self.request.get('games', 0))
+        attempts = int(self.request.get('attempts', 0))
+        query = Game.query(Game.game_over == False)
+        page, cursor, more = query.fetch_page(
+            RECONCILE_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+            projection=[Game.attempts_remaining])
+        games += len(page)
+        attempts += sum(game.attempts_remaining for game in page)
+        if more and cursor:
+            taskqueue.add(url='/tasks/reconcile_active_games',
+                          params={'cursor': cursor.urlsafe(),
+                                  'games': games,
+                                  'attempts': attempts})
+        else:
+            reconcile_active_games(games, attempts)
+        self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    @stats.instrumented('migrate_users_start')
+    def get(self):
+        """Start moving Users created before names became keys"""
+        taskqueue.add(url='/tasks/migrate_users')
+        self.response.write('User migration started.')
+
+    @stats.instrumented('migrate_users')
     def post(self):
-        """Update game listing announcement in memcache."""
-        GuessANumberApi._cache_average_attempts()
+        """Migrate one batch of Users, then queue the next batch. Once a pass
+        has moved every User the name query fallback in User.get_by_name is
+        turned off"""
+        cursor = self.request.get('cursor')
+        skipped = int(self.request.get('skipped') or 0)
+        users, cursor, more = User.query().fetch_page(
+            MIGRATE_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        for user in users:
+            if user.key.id() != user.name and not self.migrate(user):
+                skipped += 1
+        if more and cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': cursor.urlsafe(),
+                                  'skipped': skipped})
+        elif skipped:
+            logging.warning('%d Users were not migrated', skipped)
+        else:
+            Migration(id=USER_MIGRATION).put()
         self.response.set_status(204)
 
+    @staticmethod
+    def migrate(user):
+        """Re-keys a User by name, reserves their email and repoints their
+        Games and Scores. Each entity is repointed in its own transaction, so
+        a move made meanwhile is not overwritten. Each step can be safely
+        repeated, so a retried task picks up where it stopped.
+        Returns:
+            Whether the User was migrated"""
+        new_key = User.key_for(user.name)
+        new_user = new_key.get()
+        if new_user and new_user.email != user.email:
+            logging.warning('Cannot migrate User %s: the name is already taken',
+                            user.key.id())
+            return False
+        entities = [User(key=new_key, name=user.name, email=user.email)]
+        email_key = UserEmail.key_for(user.email) if user.email else None
+        if email_key and not email_key.get():
+            entities.append(UserEmail(key=email_key, user=new_key))
+        ndb.put_multi(entities)
+
+        def repoint(key):
+            entity = key.get()
+            if entity and entity.user == user.key:
+                entity.user = new_key
+                entity.put()
+
+        for model in (Game, Score):
+            query = model.query(model.user == user.key)
+            cursor, more = None, True
+            while more:
+                keys, cursor, more = query.fetch_page(
+                    MIGRATE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+                for key in keys:
+                    run_in_transaction(lambda: repoint(key))
+        user.key.delete()
+        return True
+
+
+class Stats(webapp2.RequestHandler):
+    def get(self):
+        """Report per-endpoint latency histograms and API RPC counts as
+        JSON. Admin only"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats.get_stats(), indent=2,
+                                       sort_keys=True))
+
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/crons/reconcile_active_games', ReconcileActiveGames),
+    ('/tasks/reconcile_active_games', ReconcileActiveGames),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/admin/stats', Stats),
 ], debug=True)
@@ -3,32 +3,126 @@ entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
 import random
+import time
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
+# Targets are stored in a 64-bit signed IntegerProperty
+MIN_TARGET = -2 ** 63
+MAX_TARGET = 2 ** 63 - 1
+USER_MIGRATION = 'users_by_name'
+MIGRATION_CHECK_INTERVAL = 60
+
+_finished_migrations = set()
+_migration_checks = {}
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by the user's name"""
     name = ndb.StringProperty(required=True)
     email =ndb.StringProperty()
 
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the User with a name"""
+        return ndb.Key(cls, name)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with a name, or None"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Tasklet version of get_by_name"""
+        user = yield cls.key_for(name).get_async()
+        if user is None:
+            migrated = yield Migration.is_finished_async(USER_MIGRATION)
+            if not migrated:
+                # Users created before names became keys, until they are
+                # migrated
+                user = yield cls.query(cls.name == name).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def create(cls, name, email):
+        """Creates a User keyed by name, along with a UserEmail marker that
+        reserves their email, in one cross-group transaction.
+        Raises:
+            ValueError: if the name or the email is already taken"""
+        keys = [cls.key_for(name)]
+        if email:
+            keys.append(UserEmail.key_for(email))
+        taken = ndb.get_multi(keys)
+        if taken[0]:
+            raise ValueError('A User with that name already exists!')
+        if email and taken[1]:
+            raise ValueError('A User with that email already exists!')
+        user = cls(key=keys[0], name=name, email=email)
+        entities = [user]
+        if email:
+            entities.append(UserEmail(key=keys[1], user=user.key))
+        ndb.put_multi(entities)
+        return user
+
+
+class Migration(ndb.Model):
+    """Marks that a data migration has finished, keyed by its name"""
+    finished = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def is_finished_async(cls, name):
+        """Returns whether a migration has finished. Once it has, the answer
+        is kept for the life of the instance, and until then the marker is
+        read at most every MIGRATION_CHECK_INTERVAL seconds"""
+        if name in _finished_migrations:
+            raise ndb.Return(True)
+        if time.time() - _migration_checks.get(name, 0) < \
+                MIGRATION_CHECK_INTERVAL:
+            raise ndb.Return(False)
+        _migration_checks[name] = time.time()
+        marker = yield cls.get_by_id_async(name)
+        if marker:
+            _finished_migrations.add(name)
+        raise ndb.Return(marker is not None)
+
+
+class UserEmail(ndb.Model):
+    """Reserves an email address for one User, keyed by the email"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+    @classmethod
+    def key_for(cls, email):
+        return ndb.Key(cls, email)
+
 
 class Game(ndb.Model):
     """Game object"""
-    target = ndb.IntegerProperty(required=True)
-    attempts_allowed = ndb.IntegerProperty(required=True)
+    RECENT_MOVES = 10
+    target = ndb.IntegerProperty(required=True, indexed=False)
+    attempts_allowed = ndb.IntegerProperty(required=True, indexed=False)
     attempts_remaining = ndb.IntegerProperty(required=True, default=5)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    # [move_id, message] of the last RECENT_MOVES moves sent with a move_id,
+    # so a retried request gets the original reply instead of moving again
+    recent_moves = ndb.JsonProperty(indexed=False)
 
     @classmethod
     def new_game(cls, user, min, max, attempts):
-        """Creates and returns a new game"""
+        """Creates and returns a new game with a target between min and max
+        inclusive. randint draws it in constant memory for any range that
+        fits in 64 bits"""
         if max < min:
-            raise ValueError('Maximum must be greater than minimum')
+            raise ValueError('Maximum must be greater than minimum!')
+        if min < MIN_TARGET or max > MAX_TARGET:
+            raise ValueError('Minimum and maximum must fit in 64 bits!')
         game = Game(user=user,
-                    target=random.choice(range(1, max + 1)),
+                    target=random.randint(min, max),
                     attempts_allowed=attempts,
                     attempts_remaining=attempts,
                     game_over=False)
@@ -45,28 +139,55 @@ class Game(ndb.Model):
         form.message = message
         return form
 
+    def find_move(self, move_id):
+        """Returns the message of a recent move made with a move_id, or
+        None"""
+        for recorded, message in self.recent_moves or []:
+            if recorded == move_id:
+                return message
+        return None
+
+    def remember_move(self, move_id, message):
+        """Records the message of a move made with a move_id"""
+        moves = (self.recent_moves or []) + [[move_id, message]]
+        self.recent_moves = moves[-self.RECENT_MOVES:]
+
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
         the player lost."""
         self.game_over = True
-        self.put()
-        # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
+        # Add the game to the score 'board'. It shares the Game's id, so
+        # ending a game twice cannot add a second Score
+        score = Score(id=self.key.id(), user=self.user, date=date.today(),
+                      won=won,
                       guesses=self.attempts_allowed - self.attempts_remaining)
-        score.put()
+        ndb.put_multi([self, score])
 
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)
-    won = ndb.BooleanProperty(required=True)
-    guesses = ndb.IntegerProperty(required=True)
+    won = ndb.BooleanProperty(required=True, indexed=False)
+    guesses = ndb.IntegerProperty(required=True, indexed=False)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    def to_form(self, user_name=None):
+        if user_name is None:
+            user_name = self.user.get().name
+        return ScoreForm(user_name=user_name, won=self.won,
                          date=str(self.date), guesses=self.guesses)
 
+    @classmethod
+    @ndb.tasklet
+    def to_forms_async(cls, scores):
+        """Returns a ScoreForms representation of the Scores, fetching all of
+        their users with a single batch get"""
+        user_keys = list(set(score.user for score in scores))
+        users = yield ndb.get_multi_async(user_keys)
+        names = dict((user.key, user.name) for user in users if user)
+        raise ndb.Return(ScoreForms(items=[score.to_form(names.get(score.user))
+                                           for score in scores]))
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -88,6 +209,7 @@ class NewGameForm(messages.Message):
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.IntegerField(1, required=True)
+    move_id = messages.StringField(2)
 
 
 class ScoreForm(messages.Message):
@@ -101,6 +223,8 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    more = messages.BooleanField(3)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,137 @@
+"""simulate.py - Offline batch simulator for Guess a Number.
+
+Plays large batches of games at once with NumPy under make_move's rules:
+every guess uses an attempt, a correct guess wins and a wrong guess on the
+last attempt loses. Targets and guesses are kept as uint64 offsets from the
+minimum, so any range that fits in 64 bits is simulated without overflow.
+
+For each strategy it reports the share of games won within each number of
+attempts and the fewest attempts that win a given share, which is what the
+default attempts for a range size should be tuned against.
+
+Usage:
+    python simulate.py --min 1 --max 1000000 --games 1000000
+"""
+
+from __future__ import division, print_function
+import argparse
+
+import numpy
+
+STRATEGIES = ('binary', 'random')
+ONE = numpy.uint64(1)
+
+
+def random_offsets(state, spans):
+    """Returns a uniformly random offset in [0, span] for each span in a
+    uint64 array. 64 random bits are masked to the bit length of the span,
+    and any draw that exceeds it is drawn again"""
+    masks = spans.copy()
+    for shift in (1, 2, 4, 8, 16, 32):
+        masks |= masks >> numpy.uint64(shift)
+    offsets = numpy.empty_like(spans)
+    pending = numpy.arange(len(spans))
+    while len(pending):
+        draws = numpy.frombuffer(state.bytes(8 * len(pending)),
+                                 dtype=numpy.uint64) & masks[pending]
+        fits = draws <= spans[pending]
+        offsets[pending[fits]] = draws[fits]
+        pending = pending[~fits]
+    return offsets
+
+
+def simulate(span, games, max_guesses, strategy, state):
+    """Plays games against targets drawn uniformly from [0, span]. The
+    binary strategy guesses the middle of the numbers the replies so far
+    allow, and the random strategy guesses any one of them.
+    Returns:
+        A list whose element n is the number of games won on guess n + 1,
+        for up to max_guesses guesses."""
+    spans = numpy.empty(games, dtype=numpy.uint64)
+    spans.fill(span)
+    targets = random_offsets(state, spans)
+    low = numpy.zeros(games, dtype=numpy.uint64)
+    high = spans
+    wins = []
+    while len(targets) and len(wins) < max_guesses:
+        if strategy == 'binary':
+            guesses = low + (high - low) // numpy.uint64(2)
+        else:
+            guesses = low + random_offsets(state, high - low)
+        won = guesses == targets
+        wins.append(int(won.sum()))
+        too_low = guesses < targets
+        # A guess that is too high is at least 1, so guesses - 1 only wraps
+        # where the result is discarded
+        low = numpy.where(too_low, guesses + ONE, low)
+        high = numpy.where(too_low, high, guesses - ONE)
+        playing = ~won
+        targets, low, high = targets[playing], low[playing], high[playing]
+    return wins + [0] * (max_guesses - len(wins))
+
+
+def fewest_attempts(wins, games, share):
+    """Returns the fewest attempts that win at least share of the games, or
+    None if no number of attempts simulated does"""
+    won = 0
+    for attempts, count in enumerate(wins, 1):
+        won += count
+        if won >= share * games:
+            return attempts
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--min', type=int, default=1)
+    parser.add_argument('--max', type=int, default=10)
+    parser.add_argument('--games', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=1000000,
+                        help='games simulated at once, which bounds memory')
+    parser.add_argument('--max-guesses', type=int, default=200)
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES,
+                        default=list(STRATEGIES))
+    parser.add_argument('--win-share', type=float, default=0.95,
+                        help='share of games the suggested attempts win')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    span = args.max - args.min
+    if span < 0:
+        parser.error('Maximum must be greater than minimum!')
+    if span >= 2 ** 64:
+        parser.error('The range must fit in 64 bits!')
+
+    state = numpy.random.RandomState(args.seed)
+    results = {}
+    for strategy in args.strategies:
+        wins = [0] * args.max_guesses
+        for start in range(0, args.games, args.batch_size):
+            games = min(args.batch_size, args.games - start)
+            batch = simulate(span, games, args.max_guesses, strategy, state)
+            wins = [total + count for total, count in zip(wins, batch)]
+        results[strategy] = wins
+
+    print('range           [{}, {}]'.format(args.min, args.max))
+    print('games           {}'.format(args.games))
+    print('attempts  ' + ''.join('{:>12}'.format(strategy)
+                                 for strategy in args.strategies))
+    cumulative = dict((strategy, 0) for strategy in args.strategies)
+    for attempts in range(1, args.max_guesses + 1):
+        for strategy in args.strategies:
+            cumulative[strategy] += results[strategy][attempts - 1]
+        print('{:>8}  '.format(attempts) + ''.join(
+            '{:>12.4%}'.format(cumulative[strategy] / args.games)
+            for strategy in args.strategies))
+        if all(cumulative[strategy] == args.games
+               for strategy in args.strategies):
+            break
+    for strategy in args.strategies:
+        attempts = fewest_attempts(results[strategy], args.games,
+                                   args.win_share)
+        print('{} wins {:.0%} of games with {} attempts'.format(
+            strategy, args.win_share,
+            attempts if attempts else 'more than {}'.format(args.max_guesses)))
+
+
+if __name__ == '__main__':
+    main()
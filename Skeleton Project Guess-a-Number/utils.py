@@ -1,9 +1,44 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import time
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 import endpoints
 
+import stats
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+TRANSACTION_RETRIES = 3
+RETRY_DELAY = 0.05
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string encodes, without
+        fetching the entity. Raises an error if the key String is malformed or
+        is for an entity of the incorrect kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The ndb.Key the urlsafe Key string encodes.
+    Raises:
+        endpoints.BadRequestException:"""
+    try:
+        key = ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+    if key.kind() != model._get_kind():
+        raise endpoints.BadRequestException('Incorrect Kind')
+    return key
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -33,3 +68,60 @@ def get_by_urlsafe(urlsafe, model):
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def get_page_size(page_size):
+    """Returns the number of results to page by, DEFAULT_PAGE_SIZE when none
+    was requested and at most MAX_PAGE_SIZE.
+    Raises:
+        endpoints.BadRequestException: if page_size is below 1"""
+    if page_size is None:
+        return DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException('page_size must be at least 1')
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size, cursor):
+    """Fetches one page of results from a query.
+    Args:
+        query: The ndb query to page through
+        page_size: The requested number of results, capped at MAX_PAGE_SIZE
+        cursor: The urlsafe cursor returned with the previous page, if any
+    Returns:
+        A tuple of the results, the urlsafe cursor for the next page (None on
+        the last page) and whether there are more results.
+    Raises:
+        endpoints.BadRequestException: if the cursor is malformed or the
+            page size is below 1"""
+    start_cursor = None
+    if cursor:
+        try:
+            start_cursor = Cursor(urlsafe=cursor)
+        except Exception:
+            raise endpoints.BadRequestException('Invalid Cursor')
+    page_size = get_page_size(page_size)
+    results, next_cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=start_cursor)
+    if not (more and next_cursor):
+        raise ndb.Return(results, None, False)
+    raise ndb.Return(results, next_cursor.urlsafe(), True)
+
+
+def run_in_transaction(func, retries=TRANSACTION_RETRIES, **options):
+    """Runs func in an ndb transaction, retrying up to retries times with
+    exponential backoff when it collides with another transaction on the
+    same entity group. Each retry and each final collision is counted in
+    stats.
+    Raises:
+        datastore_errors.TransactionFailedError: if every attempt collided"""
+    for attempt in range(retries + 1):
+        try:
+            return ndb.transaction(func, retries=0, **options)
+        except datastore_errors.TransactionFailedError:
+            if attempt == retries:
+                stats.count('transaction_conflicts')
+                raise
+            stats.count('transaction_retries')
+            time.sleep(RETRY_DELAY * 2 ** attempt)
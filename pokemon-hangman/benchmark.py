@@ -0,0 +1,252 @@
+"""benchmark.py - Local load test for the PokemonHangmanAPI endpoints.
+
+Runs the real endpoint methods against the App Engine testbed datastore,
+memcache and taskqueue stubs. Each virtual player creates a user, starts a
+game, guesses until the game ends and then reads its history and the
+leaderboards. Reports p50/p95/p99 latency, throughput and API RPCs per call
+for every endpoint, and writes them to a JSON file so runs can be compared.
+
+Usage:
+	python benchmark.py --sdk ~/google_appengine --players 50 --output bench.json
+	python benchmark.py --sdk ~/google_appengine --baseline bench.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+LETTER_ORDER = "aeiornltsucdpmhgbfywkvxzjq"
+
+
+def setup_sdk(sdk_path):
+	"""Puts the App Engine SDK and its bundled libraries on sys.path"""
+	sys.path.insert(0, sdk_path)
+	import dev_appserver
+	dev_appserver.fix_sys_path()
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, fraction):
+	"""Returns the nearest-rank percentile of a sorted list"""
+	if not values:
+		return 0.0
+	index = int(math.ceil(fraction * len(values))) - 1
+	return values[min(len(values) - 1, max(0, index))]
+
+
+class Recorder(object):
+	"""Times endpoint calls and counts the API RPCs each one makes, using an
+	apiproxy pre-call hook and a thread-local record of the current call"""
+
+	def __init__(self):
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.latencies = defaultdict(list)
+		self.rpcs = defaultdict(lambda: defaultdict(int))
+		self.errors = defaultdict(int)
+
+	def install(self):
+		from google.appengine.api import apiproxy_stub_map
+		apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("benchmark", self.hook)
+
+	def hook(self, service, call, request, response):
+		counts = getattr(self.local, "counts", None)
+		if counts is not None:
+			counts["{}.{}".format(service, call)] += 1
+
+	def last_counts(self):
+		"""Returns the RPCs made by the last call on this thread"""
+		return getattr(self.local, "last", {})
+
+	def call(self, name, method, request):
+		"""Calls an endpoint method, recording its latency and RPCs"""
+		self.local.counts = defaultdict(int)
+		start = time.time()
+		try:
+			return method(request)
+		except Exception:
+			with self.lock:
+				self.errors[name] += 1
+			raise
+		finally:
+			elapsed = (time.time() - start) * 1000
+			counts, self.local.counts = self.local.counts, None
+			self.local.last = counts
+			with self.lock:
+				self.latencies[name].append(elapsed)
+				for rpc, count in counts.items():
+					self.rpcs[name][rpc] += count
+
+	def report(self, wall_time):
+		results = {}
+		for name, latencies in sorted(self.latencies.items()):
+			latencies = sorted(latencies)
+			calls = len(latencies)
+			results[name] = {
+				"calls": calls,
+				"errors": self.errors.get(name, 0),
+				"p50_ms": round(percentile(latencies, 0.50), 3),
+				"p95_ms": round(percentile(latencies, 0.95), 3),
+				"p99_ms": round(percentile(latencies, 0.99), 3),
+				"throughput_per_s": round(calls / wall_time, 3) if wall_time else 0.0,
+				"rpcs_per_call": round(sum(self.rpcs[name].values()) / float(calls), 3),
+				"rpcs_by_call": dict((rpc, round(count / float(calls), 3))
+									 for rpc, count in sorted(self.rpcs[name].items())),
+			}
+		return results
+
+
+def play(api, recorder, player):
+	"""One virtual player: create a user, play a game to the end and read
+	back its history and the leaderboards"""
+	import game as game_module
+	from models import BatchGuessForm
+	from protorpc import message_types
+	user_name = "player{}".format(player)
+	recorder.call("create_user", api.create_user,
+				  game_module.USER_REQUEST.combined_message_class(user_name=user_name,
+																  email=user_name + "@example.com"))
+	form = recorder.call("new_game", api.new_game,
+						 game_module.NEW_GAME_REQUEST.combined_message_class(user_name=user_name))
+	key = form.urlsafe_key
+	recorder.call("get_game", api.get_game, game_module.GAME_REQUEST.combined_message_class(urlsafe_game_key=key))
+	letters = list(LETTER_ORDER)
+	if player % 2:
+		# Half of the players open with a batch of vowels
+		batch = [BatchGuessForm(guess=letter) for letter in letters[:3]]
+		del letters[:3]
+		result = recorder.call("guess_batch", api.guess_batch,
+							   game_module.GUESS_BATCH_REQUEST.combined_message_class(urlsafe_game_key=key,
+																					  guesses=batch))
+		form = result.game
+	while not form.game_over and letters:
+		if form.word_so_far.count("_") == 1 and random.random() < 0.5:
+			guess = form.word_so_far.replace("_", letters.pop(0))
+			method, name = api.guess_word, "guess_word"
+		else:
+			guess = letters.pop(0)
+			method, name = api.guess_letter, "guess_letter"
+		form = recorder.call(name, method,
+							 game_module.GUESS_REQUEST.combined_message_class(urlsafe_game_key=key, guess=guess))
+	recorder.call("get_game_history", api.get_game_history,
+				  game_module.GAME_PAGE_REQUEST.combined_message_class(urlsafe_game_key=key))
+	recorder.call("get_user_games", api.get_user_games,
+				  game_module.USER_PAGE_REQUEST.combined_message_class(user_name=user_name))
+	recorder.call("get_user_scores", api.get_user_scores,
+				  game_module.USER_PAGE_REQUEST.combined_message_class(user_name=user_name))
+	recorder.call("get_high_scores", api.get_high_scores,
+				  game_module.HIGH_SCORES_REQUEST.combined_message_class(number_of_results=10))
+	recorder.call("get_user_rankings", api.get_user_rankings,
+				  game_module.PAGE_REQUEST.combined_message_class())
+	recorder.call("get_scores", api.get_scores, game_module.PAGE_REQUEST.combined_message_class())
+	recorder.call("get_average_attempts", api.get_average_attempts, message_types.VoidMessage())
+
+
+def start_testbed():
+	"""Activates the testbed stubs the endpoints use"""
+	from google.appengine.datastore import datastore_stub_util
+	from google.appengine.ext import testbed
+
+	bed = testbed.Testbed()
+	bed.activate()
+	# endpoints.api_server reads the app revision from the part of the
+	# version id after the dot
+	bed.setup_env(current_version_id="testbed.1", overwrite=True)
+	policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+	bed.init_datastore_v3_stub(consistency_policy=policy)
+	bed.init_memcache_stub()
+	bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+	bed.init_app_identity_stub()
+	bed.init_urlfetch_stub()
+	return bed
+
+
+def run(players, concurrency, seed):
+	"""Plays every virtual player across a pool of threads, returning the
+	per-endpoint results and the wall time"""
+	from google.appengine.ext import ndb
+
+	random.seed(seed)
+	bed = start_testbed()
+	from game import PokemonHangmanAPI
+	recorder = Recorder()
+	recorder.install()
+	api = PokemonHangmanAPI()
+	pending = list(range(players))
+	lock = threading.Lock()
+
+	def worker():
+		ndb.set_context(ndb.make_default_context())
+		while True:
+			with lock:
+				if not pending:
+					return
+				player = pending.pop(0)
+			try:
+				play(api, recorder, player)
+			except Exception as e:
+				sys.stderr.write("player{} failed: {!r}\n".format(player, e))
+
+	start = time.time()
+	threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	wall_time = time.time() - start
+	bed.deactivate()
+	return recorder.report(wall_time), wall_time
+
+
+def compare(results, baseline):
+	"""Prints the change in p50 latency and RPCs per call against a
+	previous run"""
+	for name, current in sorted(results.items()):
+		before = baseline.get(name)
+		if not before:
+			continue
+		print("{:<24} p50 {:>8.2f} -> {:>8.2f} ms   rpcs/call {:>6.2f} -> {:>6.2f}".format(
+			name, before["p50_ms"], current["p50_ms"], before["rpcs_per_call"], current["rpcs_per_call"]))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--sdk", default=os.environ.get("APPENGINE_SDK", ""),
+						help="path to the App Engine Python SDK (or set APPENGINE_SDK)")
+	parser.add_argument("--players", type=int, default=50)
+	parser.add_argument("--concurrency", type=int, default=8)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default="bench_output.json")
+	parser.add_argument("--baseline", help="a previous output file to compare against")
+	args = parser.parse_args()
+	if not args.sdk:
+		parser.error("--sdk is required")
+	setup_sdk(args.sdk)
+
+	results, wall_time = run(args.players, args.concurrency, args.seed)
+	output = {
+		"players": args.players,
+		"concurrency": args.concurrency,
+		"seed": args.seed,
+		"wall_time_s": round(wall_time, 3),
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		"endpoints": results,
+	}
+	with open(args.output, "w") as f:
+		json.dump(output, f, indent=2, sort_keys=True)
+	for name, result in sorted(results.items()):
+		print("{:<24} {calls:>6} calls  p50 {p50_ms:>8.2f}  p95 {p95_ms:>8.2f}  p99 {p99_ms:>8.2f} ms  "
+			  "{rpcs_per_call:>6.2f} rpcs/call".format(name, **result))
+	if args.baseline:
+		with open(args.baseline) as f:
+			compare(results, json.load(f)["endpoints"])
+
+
+if __name__ == "__main__":
+	main()
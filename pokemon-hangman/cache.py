@@ -0,0 +1,114 @@
+"""cache.py - Read-through cache of User entities and of user names.
+
+Lookups check a small in-process LRU first, then go through ndb, whose global
+cache serves entities from memcache before falling back to the datastore.
+Entries expire after LRU_TTL seconds, which bounds how stale another
+instance's copy can be after a put. Games are not cached here: every move
+changes them, and a put only clears ndb's memcache copy on every instance."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+LRU_SIZE = 2000
+LRU_TTL = 5
+NAME_TIMEOUT = 24 * 60 * 60
+STATS_FLUSH_EVERY = 100
+STATS_NAMESPACE = "cache_stats"
+
+
+class LRUCache(object):
+	"""A thread-safe, size-bounded, least recently used cache whose entries
+	expire after a fixed number of seconds"""
+
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		"""Returns the cached value, or None if it is missing or expired"""
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None or entry[0] < time.time():
+				return None
+			self.entries[key] = entry
+			return entry[1]
+
+	def set(self, key, value):
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = (time.time() + self.ttl, value)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+
+_entities = LRUCache(LRU_SIZE, LRU_TTL)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(name, hit):
+	"""Counts a hit or a miss. Every STATS_FLUSH_EVERY lookups the counts are
+	added to memcache, so ratios can be read across instances, and logged"""
+	counter = name + (":hit" if hit else ":miss")
+	with _stats_lock:
+		_stats[counter] = _stats.get(counter, 0) + 1
+		if sum(_stats.values()) < STATS_FLUSH_EVERY:
+			return
+		counts = dict(_stats)
+		_stats.clear()
+	memcache.offset_multi(counts, namespace=STATS_NAMESPACE, initial_value=0)
+	logging.info("Cache lookups since last flush: %s", counts)
+
+
+def get_stats():
+	"""Returns the hit and miss counts flushed to memcache by all instances"""
+	names = ["entity", "name"]
+	counters = [name + suffix for name in names for suffix in (":hit", ":miss")]
+	return memcache.get_multi(counters, namespace=STATS_NAMESPACE)
+
+
+@ndb.tasklet
+def get_async(key):
+	"""Returns the entity for a key, reading through the in-process LRU. A
+	tasklet, so that a miss can overlap with other RPCs"""
+	entity = _entities.get(key)
+	_record("entity", entity is not None)
+	if entity is None:
+		entity = yield key.get_async()
+		if entity is not None:
+			_entities.set(key, entity)
+	raise ndb.Return(entity)
+
+
+def invalidate(key):
+	"""Drops an entity from the in-process LRU. Called from the put and
+	delete hooks of cached models"""
+	_entities.delete(key)
+
+
+def get_user_key(name, lookup):
+	"""Returns the key of the User with a name, caching the mapping in the
+	LRU and in memcache. lookup(name) is called on a miss and must return
+	the User's key or None"""
+	cache_key = ("user_name", name)
+	key = _entities.get(cache_key)
+	if key is None:
+		key = memcache.get(name, namespace="user_name")
+	_record("name", key is not None)
+	if key is None:
+		key = lookup(name)
+		if key is None:
+			return None
+		memcache.set(name, key, time=NAME_TIMEOUT, namespace="user_name")
+	_entities.set(cache_key, key)
+	return key
@@ -0,0 +1,173 @@
+"""engine.py - The rules of Pokemon Hangman, with no App Engine dependency.
+
+A game is a word, the attempts remaining, the penalty for wrong word guesses,
+a 26-bit mask of the letters a-z guessed, a list of every other guess and a
+mask of the word's revealed positions. guess_letter and guess_word apply one
+guess to any object with those attributes, a State here or a Game entity, and
+return an Outcome. The endpoints run them against Games, and simulate.py
+plays games in bulk with them."""
+
+from __future__ import division
+from collections import namedtuple
+
+BLANK = "_"
+ATTEMPTS = 6
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+# Guessing the final letter of the word scores a single point
+LETTER_WIN_SCORE = 1.0
+MIN_WORD_SCORE = 1.0
+
+# message is the reply to the player, and moved is False if the guess was
+# refused without changing the game. finished is True when the guess ended
+# the game, and won and score are then set
+Outcome = namedtuple("Outcome", ["message", "moved", "finished", "won", "score"])
+
+
+class State(object):
+	"""The state of one game, for playing without the datastore"""
+	__slots__ = ("word", "attempts_remaining", "penalty", "guessed_letters", "guessed_words",
+				 "revealed", "game_over")
+
+	def __init__(self, word, attempts_remaining=ATTEMPTS):
+		self.word = word
+		self.attempts_remaining = attempts_remaining
+		self.penalty = 0.0
+		self.guessed_letters = 0
+		self.guessed_words = []
+		self.revealed = 0
+		self.game_over = False
+
+
+def letter_bit(guess):
+	"""Returns the bit for a lowercase letter a-z in a 26-bit letter mask, or
+	0 for any other guess"""
+	if len(guess) == 1 and "a" <= guess <= "z":
+		return 1 << (ord(guess) - ord("a"))
+	return 0
+
+
+def letter_masks(word):
+	"""Returns a dict mapping each letter of word to a bitmask with bit i set
+	when the letter appears at position i"""
+	masks = {}
+	for i, ltr in enumerate(word):
+		masks[ltr] = masks.get(ltr, 0) | (1 << i)
+	return masks
+
+
+def word_index(word):
+	"""Returns the lowercased form of a word and its letter position masks"""
+	lower = word.lower()
+	return lower, letter_masks(lower)
+
+
+def render_word(word, word_so_far, mask):
+	"""Returns word_so_far with every position set in mask filled in from word"""
+	return "".join(ltr if mask >> i & 1 else blank
+				   for i, (ltr, blank) in enumerate(zip(word, word_so_far)))
+
+
+def word_so_far(game):
+	"""Returns the word with every position not yet revealed blanked out"""
+	return render_word(game.word, BLANK * len(game.word), game.revealed)
+
+
+def past_guesses(game):
+	"""Returns the lowercased guesses made so far: the letters a-z in
+	alphabetical order, then every other guess in the order it was made"""
+	return [ltr for ltr in LETTERS if game.guessed_letters & letter_bit(ltr)] + game.guessed_words
+
+
+def has_guessed(game, guess):
+	"""Returns True if a lowercased guess was already made"""
+	bit = letter_bit(guess)
+	if bit:
+		return bool(game.guessed_letters & bit)
+	return guess in game.guessed_words
+
+
+def add_guess(game, guess):
+	"""Records a lowercased guess"""
+	bit = letter_bit(guess)
+	if bit:
+		game.guessed_letters |= bit
+	else:
+		game.guessed_words.append(guess)
+
+
+def blanks(game):
+	"""Returns the number of positions of the word not yet revealed"""
+	return len(game.word) - bin(game.revealed).count("1")
+
+
+def word_score(blank_count, length, penalty):
+	"""Scores a correct word guess: the share of the word still blank out of
+	10, less the penalty, rounded to one decimal place. A correct guess up
+	front scores 10.0 and one with a single letter left about 1.0, but never
+	less than MIN_WORD_SCORE"""
+	return max(round(blank_count / length * 10 - penalty, 1), MIN_WORD_SCORE)
+
+
+def _refuse(message):
+	return Outcome(message, False, False, False, 0.0)
+
+
+def _continue(message):
+	return Outcome(message, True, False, False, 0.0)
+
+
+def _finish(game, message, won, score):
+	game.game_over = True
+	return Outcome(message, True, True, won, score)
+
+
+def guess_letter(game, guess, index=None):
+	"""Applies a letter guess to a game in place. index is the word's
+	word_index, if the caller has it cached.
+	Returns:
+		An Outcome."""
+	if game.game_over:
+		return _refuse("Game is already over!")
+	if not guess:
+		return _refuse("Please guess a letter.")
+	letter = guess.lower()
+	if has_guessed(game, letter):
+		return _refuse("You already guessed that letter!")
+	if len(guess) != 1:
+		return _refuse("You can only guess a single letter.")
+
+	add_guess(game, letter)
+	mask = (index or word_index(game.word))[1].get(letter, 0)
+	if mask:
+		game.revealed |= mask
+		if not blanks(game):
+			return _finish(game, "You won! Score is 1.", True, LETTER_WIN_SCORE)
+		return _continue("Correct guess! Word so far: " + word_so_far(game))
+	game.attempts_remaining -= 1
+	if game.attempts_remaining < 1:
+		return _finish(game, "Game over! Score is 0. Correct word is: " + game.word, False, 0.0)
+	return _continue("Incorrect guess! Word so far: " + word_so_far(game))
+
+
+def guess_word(game, guess, index=None):
+	"""Applies a whole word guess to a game in place. A wrong guess costs an
+	attempt and adds a point to the penalty. index is the word's word_index,
+	if the caller has it cached.
+	Returns:
+		An Outcome."""
+	if game.game_over:
+		return _refuse("Game is already over!")
+	word = guess.lower()
+	if has_guessed(game, word):
+		return _refuse("You already guessed that word!")
+
+	add_guess(game, word)
+	if word == (index or word_index(game.word))[0]:
+		score = word_score(blanks(game), len(game.word), game.penalty)
+		game.revealed = (1 << len(game.word)) - 1
+		return _finish(game, "You won! Score is " + str(score) + ".", True, score)
+	game.attempts_remaining -= 1
+	if game.attempts_remaining < 1:
+		return _finish(game, "Game over! Score is 0. Correct word is: " + game.word, False, 0.0)
+	game.penalty += 1.0
+	return _continue("Incorrect guess! Penalty is " + str(game.penalty) + ". Word so far: " + word_so_far(game))
@@ -0,0 +1,256 @@
+"""export.py - Streaming, resumable export of scores, games and move history.
+
+An export walks the Score or Game entities in fixed-size batches with a
+query cursor. Games and history exports then walk the GameArchive records,
+one archive per batch, so only one archive is decompressed at a time. Each
+batch becomes one gzip compressed chunk of newline
+delimited JSON or CSV (with its own header row), handed to a sink, so at most
+one batch is held in memory. After every chunk the Export entity checkpoints
+the cursor, prefixed with ARCHIVE_PHASE once the archives are being walked,
+so a retried task resumes from the last chunk written. Chunk names
+are derived from their number, so a chunk rewritten by a retry replaces the
+earlier copy.
+
+Sinks take (name, data). LocalSink writes files and is meant for tests and
+the development server; CloudStorageSink needs the cloudstorage client
+library vendored into the app. Other sinks can be added to SINKS."""
+
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime
+from google.appengine.ext import ndb
+
+from models import Game, GameArchive, History, Score, _user_names
+from utils import get_cursor
+
+BATCH_SIZE = 500
+MAX_BATCH_SIZE = 1000
+FORMATS = ("ndjson", "csv")
+ARCHIVE_PHASE = "archive:"
+
+
+class Export(ndb.Model):
+	"""The checkpoint of one export: the cursor the next batch starts from
+	and the chunks and rows written so far"""
+	kind = ndb.StringProperty(required=True, indexed=False)
+	format = ndb.StringProperty(required=True, indexed=False)
+	sink = ndb.StringProperty(required=True, indexed=False)
+	batch_size = ndb.IntegerProperty(default=BATCH_SIZE, indexed=False)
+	cursor = ndb.StringProperty(indexed=False)
+	chunks = ndb.IntegerProperty(default=0, indexed=False)
+	rows = ndb.IntegerProperty(default=0, indexed=False)
+	done = ndb.BooleanProperty(default=False, indexed=False)
+	started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+	def to_dict(self):
+		return {"id": self.key.id(), "kind": self.kind, "format": self.format, "sink": self.sink,
+				"chunks": self.chunks, "rows": self.rows, "done": self.done}
+
+
+class LocalSink(object):
+	"""Writes chunks as files under a directory"""
+
+	def __init__(self, root):
+		self.root = root
+
+	def write(self, name, data):
+		path = os.path.join(self.root, name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		# Written aside and renamed, so a chunk is never seen half written
+		with open(path + ".tmp", "wb") as f:
+			f.write(data)
+		os.rename(path + ".tmp", path)
+
+
+class CloudStorageSink(object):
+	"""Writes chunks as objects under a Cloud Storage path ("bucket/prefix")"""
+
+	def __init__(self, path):
+		self.path = "/" + path.strip("/")
+
+	def write(self, name, data):
+		import cloudstorage
+		with cloudstorage.open("{}/{}".format(self.path, name), "w", content_type="application/gzip") as f:
+			f.write(data)
+
+
+SINKS = {"file": LocalSink, "gs": CloudStorageSink}
+
+
+def get_sink(url):
+	"""Returns the sink for a URL such as file:///tmp/exports or
+	gs://bucket/exports.
+	Raises:
+		ValueError: if no sink handles the URL's scheme"""
+	scheme, _, path = url.partition("://")
+	if scheme not in SINKS or not path:
+		raise ValueError("Unknown export sink: {}".format(url))
+	return SINKS[scheme](path)
+
+
+def _isoformat(value):
+	return value.isoformat() if value else None
+
+
+def _score_rows(scores):
+	names = _user_names(scores)
+	for score in scores:
+		yield {"key": score.key.urlsafe(), "user_name": names.get(score.user), "date": _isoformat(score.date),
+			   "won": score.won, "score": score.score}
+
+
+def _game_rows(games):
+	names = _user_names(games)
+	for game in games:
+		yield {"key": game.key.urlsafe(), "user_name": names.get(game.user), "word": game.word,
+			   "word_so_far": game.word_so_far, "attempts_remaining": game.attempts_remaining,
+			   "guesses": game.guess_count, "penalty": game.penalty, "game_over": game.game_over,
+			   "finished": _isoformat(game.finished)}
+
+
+def _history_rows(games):
+	names = _user_names(games)
+	# Games from older versions may still keep their history as child entities
+	legacy = dict((game.key, History.query(ancestor=game.key).fetch_async())
+				  for game in games if not game.history_inline)
+	for game in games:
+		moves = game.history
+		if game.key in legacy:
+			moves = sorted(legacy[game.key].get_result(), key=lambda move: move.order) + moves
+		for move in moves:
+			yield {"game_key": game.key.urlsafe(), "user_name": names.get(game.user), "order": move.order,
+				   "guess": move.guess, "message": move.message}
+
+
+def _archived_games(archive):
+	"""Returns the Games stored in one GameArchive record"""
+	user = archive.key.parent()
+	return [Game.from_archive(ndb.Key(Game, int(game_id), parent=user), record)
+			for game_id, record in sorted(archive.get_records().items(), key=lambda item: int(item[0]))]
+
+
+# kind: (model whose entities are paged through, columns, rows of a batch,
+# whether GameArchive records are walked afterwards)
+KINDS = {
+	"scores": (Score, ["key", "user_name", "date", "won", "score"], _score_rows, False),
+	"games": (Game, ["key", "user_name", "word", "word_so_far", "attempts_remaining", "guesses", "penalty",
+					 "game_over", "finished"], _game_rows, True),
+	"history": (Game, ["game_key", "user_name", "order", "guess", "message"], _history_rows, True),
+}
+
+
+def _csv_value(value):
+	if value is None:
+		return ""
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	return str(value)
+
+
+def encode_chunk(rows, fields, fmt):
+	"""Returns rows, dicts keyed by fields, as gzip compressed newline
+	delimited JSON or as CSV with a header row"""
+	buf = io.BytesIO()
+	with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+		if fmt == "csv":
+			writer = csv.writer(f)
+			writer.writerow(fields)
+			for row in rows:
+				writer.writerow([_csv_value(row[field]) for field in fields])
+		else:
+			for row in rows:
+				f.write(json.dumps(row, sort_keys=True, separators=(",", ":")) + "\n")
+	return buf.getvalue()
+
+
+def export_chunks(kind, fmt, cursor=None, batch_size=BATCH_SIZE):
+	"""Yields one compressed chunk for each batch of entities of a kind,
+	starting from a urlsafe cursor, fetching each batch only once the
+	previous chunk has been consumed. Kinds that include archived games go
+	on to yield a chunk for each GameArchive record.
+	Yields:
+		The chunk, its number of rows, the cursor of the next batch and
+		whether there are more batches."""
+	model, fields, to_rows, archived = KINDS[kind]
+	archives = bool(cursor and cursor.startswith(ARCHIVE_PHASE))
+	start_cursor = get_cursor(cursor[len(ARCHIVE_PHASE):] if archives else cursor)
+	while True:
+		if archives:
+			records, next_cursor, more = GameArchive.query().fetch_page(1, start_cursor=start_cursor)
+			entities = _archived_games(records[0]) if records else []
+		else:
+			entities, next_cursor, more = model.query().fetch_page(batch_size, start_cursor=start_cursor)
+		rows = list(to_rows(entities))
+		more = bool(more and next_cursor)
+		if more:
+			next_batch = (ARCHIVE_PHASE if archives else "") + next_cursor.urlsafe()
+		elif archived and not archives:
+			# The live Games are done, so the archives come next
+			archives, more, next_cursor, next_batch = True, True, None, ARCHIVE_PHASE
+		else:
+			next_batch = None
+		yield encode_chunk(rows, fields, fmt), len(rows), next_batch, more
+		if not more:
+			return
+		start_cursor = next_cursor
+
+
+def start(kind, fmt, sink, batch_size=BATCH_SIZE):
+	"""Creates the checkpoint of a new export. The batch size is capped at
+	MAX_BATCH_SIZE.
+	Raises:
+		ValueError: if the kind, format or sink is unknown, or the batch size
+			is below 1"""
+	if batch_size < 1:
+		raise ValueError("Batch size must be at least 1")
+	batch_size = min(batch_size, MAX_BATCH_SIZE)
+	if kind not in KINDS:
+		raise ValueError("Unknown export kind: {}".format(kind))
+	if fmt not in FORMATS:
+		raise ValueError("Unknown export format: {}".format(fmt))
+	get_sink(sink)
+	export_id = "{}-{}".format(kind, datetime.now().strftime("%Y%m%dT%H%M%S%f"))
+	export = Export(id=export_id, kind=kind, format=fmt, sink=sink, batch_size=batch_size)
+	export.put()
+	return export
+
+
+@ndb.transactional
+def _checkpoint(export_id, chunks, rows, cursor, done):
+	"""Records a written chunk, unless another run of the same export got
+	there first.
+	Returns:
+		The updated Export, or None if it had already moved on."""
+	export = Export.get_by_id(export_id)
+	if export.done or export.chunks != chunks - 1:
+		return None
+	export.chunks, export.rows, export.cursor, export.done = chunks, export.rows + rows, cursor, done
+	export.put()
+	return export
+
+
+def run(export_id, max_chunks):
+	"""Writes up to max_chunks chunks of an export to its sink, resuming
+	from its checkpoint.
+	Returns:
+		The Export as last checkpointed."""
+	export = Export.get_by_id(export_id)
+	if not export or export.done:
+		return export
+	sink = get_sink(export.sink)
+	chunks = export_chunks(export.kind, export.format, export.cursor, export.batch_size)
+	for written, (data, rows, cursor, more) in enumerate(chunks, 1):
+		number = export.chunks + 1
+		sink.write("{}/{}-{:05d}.{}.gz".format(export.key.id(), export.kind, number, export.format), data)
+		checkpointed = _checkpoint(export.key.id(), number, rows, cursor, not more)
+		if not checkpointed:
+			return Export.get_by_id(export_id)
+		export = checkpointed
+		if written >= max_chunks:
+			break
+	chunks.close()
+	return export
@@ -1,23 +1,37 @@
 """game.py - Contains all of the APIs and game logic"""
 
 from __future__ import division
+import json
+import logging
+import uuid
 import endpoints
+from datetime import date, datetime
 from protorpc import remote, messages
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
-from models import User, Game, Score, History
-from models import UserForm, UserForms, GameForm, GameForms, NewGameForm, GuessForm, ScoreForm, ScoreForms, HistoryForm, HistoryForms, StringMessage
+from models import User, Game, GameArchive, Score, Ranking, PeriodScore, Leaderboard, POKEMON_LIST
+from models import UserForm, UserForms, GameForm, GameForms, NewGameForm, GuessForm, GuessBatchForm, GuessBatchResultForm, HintForm, ScoreForm, ScoreForms, HistoryForm, HistoryForms, StringMessage
 
-from utils import get_by_urlsafe
+import stats
+import tokens
+from counters import update_active_games, get_active_games
+from stats import instrumented
+from utils import get_key_by_urlsafe, fetch_page, fetch_page_async, page_list, run_in_transaction
 
 
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1), email=messages.StringField(2))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1), email=messages.StringField(2), page_size=messages.IntegerField(3), cursor=messages.StringField(4))
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GAME_REQUEST = endpoints.ResourceContainer(urlsafe_game_key=messages.StringField(1))
+GAME_PAGE_REQUEST = endpoints.ResourceContainer(urlsafe_game_key=messages.StringField(1), page_size=messages.IntegerField(2), cursor=messages.StringField(3))
 GUESS_REQUEST = endpoints.ResourceContainer(GuessForm, urlsafe_game_key=messages.StringField(1))
+GUESS_BATCH_REQUEST = endpoints.ResourceContainer(GuessBatchForm, urlsafe_game_key=messages.StringField(1))
+MAX_BATCH_GUESSES = 50
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(number_of_results=messages.IntegerField(1))
-MEMCACHE_GUESSES_REMAINING = "GUESSES_REMAINING"
+PAGE_REQUEST = endpoints.ResourceContainer(page_size=messages.IntegerField(1), cursor=messages.StringField(2))
+PERIOD_PAGE_REQUEST = endpoints.ResourceContainer(window=messages.StringField(1), date=messages.StringField(2), page_size=messages.IntegerField(3), cursor=messages.StringField(4))
 
 
 @endpoints.api(name="pokemon_hangman", version="v1")
@@ -28,14 +42,17 @@ class PokemonHangmanAPI(remote.Service):
 					  path="user",
 					  name="create_user",
 					  http_method="POST")
+	@instrumented
 	def create_user(self, request):
-		"""Create a User. Username must be unique"""
-		if User.query(User.name == request.user_name).get():
+		"""Create a User. Username and email must be unique"""
+		if not request.user_name:
+			raise endpoints.BadRequestException("A user name is required!")
+		if User.get_by_name(request.user_name):
 			raise endpoints.ConflictException("A User with that name already exists!")
-		if User.query(User.email == request.email).get():
-			raise endpoints.ConflictException("A User with that email already exists!")
-		user = User(name=request.user_name, email=request.email)
-		user.put()
+		try:
+			User.create(request.user_name, request.email)
+		except ValueError, e:
+			raise endpoints.ConflictException(str(e))
 		return StringMessage(message="User {} created!".format(request.user_name))
 
 
@@ -44,14 +61,14 @@ class PokemonHangmanAPI(remote.Service):
 					  path="game",
 					  name="new_game",
 					  http_method="POST")
+	@instrumented
 	def new_game(self, request):
 		"""Create a new game."""
-		user = User.query(User.name == request.user_name).get()
+		user = User.get_by_name(request.user_name)
 		if not user:
 			raise endpoints.NotFoundException("A user with that name does not exist!")
-		game = Game.new_game(user.key)
-		# Task queue updates average attempts remaining.
-		taskqueue.add(url="/tasks/cache_average_attempts")
+		game = Game.new_game(user.key, user.name)
+		update_active_games(1, game.attempts_remaining)
 		return game.to_form("Good luck playing Pokemon Hangman!")
 
 
@@ -60,9 +77,10 @@ class PokemonHangmanAPI(remote.Service):
 					  path="game/{urlsafe_game_key}",
 					  name="get_game",
 					  http_method="GET")
+	@instrumented
 	def get_game(self, request):
 		"""Return the current game state."""
-		game = get_by_urlsafe(request.urlsafe_game_key, Game)
+		game = Game.get_with_archive(get_key_by_urlsafe(request.urlsafe_game_key, Game))
 		if game:
 			return game.to_form("Guess a letter!")
 		else:
@@ -74,54 +92,12 @@ class PokemonHangmanAPI(remote.Service):
 					  path="game/{urlsafe_game_key}/letter",
 					  name="guess_letter",
 					  http_method="PUT")
+	@instrumented
 	def guess_letter(self, request):
 		"""Guesses a letter. Returns game state with message."""
-		game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-		# Ensure valid input
-		if game:
-			if game.game_over:
-				return game.to_form("Game is already over!")
-		else:
-			raise endpoints.NotFoundException("Game not found. Start a new game!")
-		if not request.guess:
-			return game.to_form("Please guess a letter.")
-		if request.guess.lower() in game.past_guesses:
-			return game.to_form("You already guessed that letter!")
-		if len(request.guess) != 1:
-			return game.to_form("You can only guess a single letter.")
-
-		# Assess the guessed letter
-		game.past_guesses.append(request.guess.lower())
-		move_number = len(game.past_guesses)
-		if request.guess.lower() in game.word.lower():
-			guess_instances = [i for i, ltr in enumerate(game.word.lower()) if ltr == request.guess.lower()]
-			for i in guess_instances:
-				game.word_so_far = game.word_so_far[:i] + game.word[i] + game.word_so_far[i+1:]
-			if game.word_so_far == game.word:
-				# 1 point for guessing final letter
-				message = "You won! Score is 1."
-				game.save_history(request.guess, message, move_number)
-				game.end_game(True, 1.0)
-				return game.to_form(message)
-			else:
-				message = "Correct guess! Word so far: " + game.word_so_far
-				game.save_history(request.guess, message, move_number)
-				game.put()
-				return game.to_form(message)
-		else:
-			game.attempts_remaining -= 1
-			if game.attempts_remaining < 1:
-				# 0 points for loss
-				message = "Game over! Score is 0. Correct word is: " + game.word
-				game.save_history(request.guess, message, move_number)
-				game.end_game(False, 0.0)
-				return game.to_form(message)
-			else:
-				message = "Incorrect guess! Word so far: " + game.word_so_far
-				game.save_history(request.guess, message, move_number)
-				game.put()
-				return game.to_form(message)
+		game, message = self._make_move(request.urlsafe_game_key, request.guess, self._assess_letter,
+										request.state_token, request.move_id)
+		return game.to_form(message)
 
 
 	@endpoints.method(request_message=GUESS_REQUEST,
@@ -129,92 +105,111 @@ class PokemonHangmanAPI(remote.Service):
 					  path="game/{urlsafe_game_key}/word",
 					  name="guess_word",
 					  http_method="PUT")
+	@instrumented
 	def guess_word(self, request):
 		"""Guesses the entire word. Returns game state with message."""
-		game = get_by_urlsafe(request.urlsafe_game_key, Game)
-		if game:
-			if game.game_over:
-				return game.to_form("Game is already over!")
-		else:
-			raise endpoints.NotFoundException("Game not found. Start a new game!")
-		if request.guess.lower() in game.past_guesses:
-			return game.to_form("You already guessed that word!")
-		game.past_guesses.append(request.guess.lower())
-		move_number = len(game.past_guesses)
-		if request.guess.lower() == game.word.lower():
-			# Algorithm for calculating score:
-			# round to one decimal place:
-			# (blanks remaining / length of word * 10) - penalty
-			# --> Correct guess up front = 10.0 pts
-			# --> Correct guess w/ one letter left ~= 1.0 pt
-			# penalty == incorrect word (not letter) guesses
-			score = round((game.word_so_far.count('_') / len(game.word)) * 10 - game.penalty, 1)
-			if score < 1.0:
-				score = 1.0
-			game.word_so_far = game.word
-			message = "You won! Score is " + str(score) + "."
-			game.save_history(request.guess, message, move_number)
-			game.end_game(True, score)
-			return game.to_form(message)
-		game.attempts_remaining -= 1
-		if game.attempts_remaining < 1:
-			message = "Game over! Score is 0. Correct word is: " + game.word
-			game.save_history(request.guess, message, move_number)
-			game.end_game(False, 0.0)
-			return game.to_form(message)
+		game, message = self._make_move(request.urlsafe_game_key, request.guess, self._assess_word,
+										request.state_token, request.move_id)
+		return game.to_form(message)
+
+
+	@endpoints.method(request_message=GUESS_BATCH_REQUEST,
+					  response_message=GuessBatchResultForm,
+					  path="game/{urlsafe_game_key}/batch",
+					  name="guess_batch",
+					  http_method="PUT")
+	@instrumented
+	def guess_batch(self, request):
+		"""Applies an ordered list of letter and word guesses in one request,
+		stopping at the end of the game. Returns the final game state and the
+		message for each guess applied."""
+		if len(request.guesses) > MAX_BATCH_GUESSES:
+			raise endpoints.BadRequestException("At most {} guesses can be sent at once.".format(MAX_BATCH_GUESSES))
+		moves = [(item.guess, self._assess_word if item.word else self._assess_letter) for item in request.guesses]
+		game, replies = self._make_moves(request.urlsafe_game_key, moves, request.state_token, request.move_id)
+		form = game.to_form(replies[-1] if replies else "Guess a letter!")
+		return GuessBatchResultForm(game=form, move_messages=replies)
+
+
+	@endpoints.method(request_message=GAME_REQUEST,
+					  response_message=HintForm,
+					  path="game/{urlsafe_game_key}/hint",
+					  name="get_hint",
+					  http_method="GET")
+	@instrumented
+	def get_hint(self, request):
+		"""Suggests the letter that narrows down the Pokemon still fitting the
+		game the most, or the name itself once only one fits."""
+		game = Game.get_with_archive(get_key_by_urlsafe(request.urlsafe_game_key, Game))
+		if not game:
+			raise endpoints.NotFoundException("Game not found!")
+		if game.game_over:
+			return HintForm(message="Game is already over!")
+		hint = POKEMON_LIST.get_candidate_index().hint(game.word_so_far, game.past_guesses)
+		if hint.word:
+			message = "Only one Pokemon fits. Guess the word!"
+		elif hint.letter:
+			message = "Try guessing '{}'. {} Pokemon still fit.".format(hint.letter, hint.candidates)
+		elif hint.candidates:
+			message = "{} Pokemon still fit, and no letter left tells them apart. Guess a name!".format(hint.candidates)
 		else:
-			# Assess a penalty for incorrect guess (subtracted from total score)
-			game.penalty += 1.0
-			message = "Incorrect guess! Penalty is " + str(game.penalty) + ". Word so far: " + game.word_so_far
-			game.save_history(request.guess, message, move_number)
-			game.put()
-			return game.to_form(message)
+			message = "No Pokemon fits this game."
+		return HintForm(message=message, letter=hint.letter, word=hint.word,
+						candidates=hint.candidates, entropy=round(hint.entropy, 3))
 
 
-	@endpoints.method(response_message=ScoreForms,
+	@endpoints.method(request_message=PAGE_REQUEST,
+					  response_message=ScoreForms,
 					  path='scores',
 					  name='get_scores',
 					  http_method='GET')
+	@instrumented
 	def get_scores(self, request):
-		"""Return all scores"""
-		return ScoreForms(items=[score.to_form() for score in Score.query()])
+		"""Return a page of all scores, newest first"""
+		query = Score.query().order(-Score.date)
+		scores, cursor, more = fetch_page(query, request.page_size, request.cursor)
+		forms = Score.to_forms(scores)
+		forms.next_cursor, forms.more = cursor, more
+		return forms
 
 
-	@endpoints.method(request_message=USER_REQUEST,
+	@endpoints.method(request_message=USER_PAGE_REQUEST,
 					  response_message=ScoreForms,
 					  path='scores/user/{user_name}',
 					  name='get_user_scores',
 					  http_method='GET')
+	@instrumented
 	def get_user_scores(self, request):
-		"""Returns all of an individual User's scores"""
-		user = User.query(User.name == request.user_name).get()
-		if not user:
-			raise endpoints.NotFoundException('A User with that name does not exist!')
-		scores = Score.query(Score.user == user.key)
-		return ScoreForms(items=[score.to_form() for score in scores])
+		"""Returns a page of an individual User's scores"""
+		user, scores, cursor, more = self._fetch_user_page(Score, request).get_result()
+		return ScoreForms(items=[score.to_form(user.name) for score in scores],
+						  next_cursor=cursor, more=more)
 
 
 	@endpoints.method(response_message=StringMessage,
 					  path='games/average_attempts',
 					  name='get_average_attempts_remaining',
 					  http_method='GET')
+	@instrumented
 	def get_average_attempts(self, request):
-		"""Get the cached average moves remaining"""
-		return StringMessage(message=memcache.get(MEMCACHE_GUESSES_REMAINING) or '')
+		"""Get the average moves remaining from the sharded counters"""
+		games, attempts = get_active_games()
+		if games < 1:
+			return StringMessage(message='')
+		return StringMessage(message='The average moves remaining is {:.2f}'.format(attempts / games))
 
 
-	@endpoints.method(request_message=USER_REQUEST,
+	@endpoints.method(request_message=USER_PAGE_REQUEST,
 					  response_message=GameForms,
 					  path="games/user/{user_name}",
 					  name="get_user_games",
 					  http_method="GET")
+	@instrumented
 	def get_user_games(self, request):
-		"""Get all games created by user."""
-		user = User.query(User.name == request.user_name).get()
-		if not user:
-			raise endpoints.NotFoundException('A User with that name does not exist!')
-		query = Game.query(ancestor=user.key)
-		return GameForms(items=[game.to_form("") for game in query])
+		"""Get a page of the games created by user."""
+		user, games, cursor, more = self._fetch_user_page(Game, request).get_result()
+		return GameForms(items=[game.to_form("", user.name, with_token=False) for game in games],
+						 next_cursor=cursor, more=more)
 
 
 	@endpoints.method(request_message=GAME_REQUEST,
@@ -222,14 +217,30 @@ class PokemonHangmanAPI(remote.Service):
 					  path="game/{urlsafe_game_key}/cancel",
 					  name="cancel_game",
 					  http_method="DELETE")
+	@instrumented
 	def cancel_game(self, request):
-		"""Cancels a game by deleting it from the Datastore"""
-		game = get_by_urlsafe(request.urlsafe_game_key, Game)
+		"""Cancels a game by deleting it from the Datastore. The read and the
+		delete share a transaction, so concurrent cancels and moves cannot
+		both count the game as ended"""
+		game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+
+		def cancel():
+			game = game_key.get()
+			if game and not game.game_over:
+				game.key.delete()
+				return game, True
+			return game, False
+
+		try:
+			game, cancelled = run_in_transaction(cancel)
+		except datastore_errors.TransactionFailedError:
+			raise endpoints.ConflictException("The game is busy. Try again.")
+		if cancelled:
+			update_active_games(-1, -game.attempts_remaining)
+			return game.to_form("Game cancelled", with_token=False)
+		game = game or GameArchive.get_game(game_key)
 		if game:
-			if game.game_over:
-				return game.to_form("Game is already over!")
-			game.key.delete()
-			return game.to_form("Game cancelled")
+			return game.to_form("Game is already over!")
 		else:
 			raise endpoints.NotFoundException("Game not found!")
 
@@ -239,57 +250,307 @@ class PokemonHangmanAPI(remote.Service):
 					  path="high_scores",
 					  name="get_high_scores",
 					  http_method="GET")
+	@instrumented
 	def get_high_scores(self, request):
 		"""Returns the n highest scores"""
 		number_of_results = 5 # default
-		if request.number_of_results:
+		if request.number_of_results is not None:
 			number_of_results = request.number_of_results
+		if number_of_results < 1:
+			raise endpoints.BadRequestException("number_of_results must be at least 1")
+		if number_of_results <= Leaderboard.SIZE:
+			entries = Leaderboard.get_entries()[:number_of_results]
+			return ScoreForms(items=[entry.to_form() for entry in entries])
+		# Users are looked up while later results are still being fetched
 		query = Score.query().order(-Score.score)
-		results = query.fetch(limit=number_of_results)
-		return ScoreForms(items=[result.to_form() for result in results])
+		return ScoreForms(items=query.map(Score.to_form_async, limit=number_of_results))
 
 
-	@endpoints.method(response_message=UserForms,
+	@endpoints.method(request_message=PAGE_REQUEST,
+					  response_message=UserForms,
 					  path="user_rankings",
 					  name="get_user_rankings",
 					  http_method="GET")
+	@instrumented
 	def get_user_rankings(self, request):
-		"""Ranks users by their total score."""
-		results = []
-		users = User.query()
-		for user in users:
-			query = Score.query(ancestor=user.key)
-			total_score = sum([score.score for score in query])
-			results.append((user, total_score))
-		results.sort(key=lambda tup: tup[1], reverse=True)
-		return UserForms(items=[result[0].to_form(result[1]) for result in results])
+		"""Ranks users by their total score, one page at a time."""
+		query = Ranking.query().order(-Ranking.total_score)
+		rankings, cursor, more = fetch_page(query, request.page_size, request.cursor)
+		return UserForms(items=[ranking.to_form() for ranking in rankings],
+						 next_cursor=cursor, more=more)
 
 
-	@endpoints.method(request_message=GAME_REQUEST,
+	@endpoints.method(request_message=PERIOD_PAGE_REQUEST,
+					  response_message=UserForms,
+					  path="user_rankings/{window}",
+					  name="get_period_rankings",
+					  http_method="GET")
+	@instrumented
+	def get_period_rankings(self, request):
+		"""Ranks users by their total score in the day, week or month
+		containing date (YYYY-MM-DD, today by default), one page at a time."""
+		if request.window not in PeriodScore.WINDOWS:
+			raise endpoints.BadRequestException("Window must be day, week or month.")
+		day = date.today()
+		if request.date:
+			try:
+				day = datetime.strptime(request.date, "%Y-%m-%d").date()
+			except ValueError:
+				raise endpoints.BadRequestException("Date must be in YYYY-MM-DD format.")
+		period = PeriodScore.period_for(request.window, day)
+		query = PeriodScore.query(PeriodScore.period == period).order(-PeriodScore.total_score)
+		buckets, cursor, more = fetch_page(query, request.page_size, request.cursor)
+		return UserForms(items=[bucket.to_form() for bucket in buckets],
+						 next_cursor=cursor, more=more)
+
+
+	@endpoints.method(request_message=GAME_PAGE_REQUEST,
 					  response_message=HistoryForms,
 					  path="game/{urlsafe_game_key}/history",
 					  name="get_game_history",
 					  http_method="GET")
+	@instrumented
 	def get_game_history(self, request):
-		"""Returns a history of all moves made in game."""
-		game = get_by_urlsafe(request.urlsafe_game_key, Game)
+		"""Returns a page of the history of moves made in game, in order."""
+		game = Game.get_with_archive(get_key_by_urlsafe(request.urlsafe_game_key, Game))
 		if game:
-			history = History.query(ancestor=game.key).order(History.order)
-			return HistoryForms(items=[move.to_form() for move in history])
+			if not game.history_inline:
+				game = Game.migrate_history(game.key)
+			history, cursor, more = page_list(game.history, request.page_size, request.cursor)
+			return HistoryForms(items=[move.to_form() for move in history],
+								next_cursor=cursor, more=more)
 		else:
 			raise endpoints.NotFoundException("Game not found!")
 
 
 	@staticmethod
-	def _cache_average_attempts():
-		"""Populates memcache with the average moves remaining of Games"""
-		games = Game.query(Game.game_over == False).fetch()
-		if games:
-			count = len(games)
-			total_attempts_remaining = sum([game.attempts_remaining
-										for game in games])
-			average = float(total_attempts_remaining)/count
-			memcache.set(MEMCACHE_GUESSES_REMAINING,
-						 'The average moves remaining is {:.2f}'.format(average))
+	@ndb.tasklet
+	def _fetch_user_page(model, request):
+		"""Fetches a page of the Games or Scores of the user named in a
+		request. Users are keyed by name, so the page is fetched while the
+		User is looked up, and only fetched again for a User created before
+		that and not yet migrated.
+		Returns:
+			The User, the page of entities, the cursor for the next page and
+			whether there are more.
+		Raises:
+			endpoints.NotFoundException: if there is no such User"""
+		user_key = User.key_for(request.user_name)
+		page_future = fetch_page_async(model.query(ancestor=user_key), request.page_size, request.cursor)
+		user = yield User.get_by_name_async(request.user_name)
+		if not user:
+			raise endpoints.NotFoundException('A User with that name does not exist!')
+		if user.key != user_key:
+			# The cursor belongs to the legacy query, so page_future is dropped
+			page = yield fetch_page_async(model.query(ancestor=user.key), request.page_size, request.cursor)
+		else:
+			page = yield page_future
+		raise ndb.Return((user,) + page)
+
+	@classmethod
+	def _make_move(cls, urlsafe_game_key, guess, assess, state_token=None, move_id=None):
+		"""Applies a single guess to a game with _make_moves.
+		Returns:
+			The updated Game and the message for the player."""
+		game, replies = cls._make_moves(urlsafe_game_key, [(guess, assess)], state_token, move_id)
+		return game, replies[0]
+
+	@classmethod
+	def _make_moves(cls, urlsafe_game_key, moves, state_token=None, move_id=None):
+		"""Applies guesses to a game in order, stopping once the game is over.
+		A valid state token lets the guesses be evaluated without reading the
+		Game (see _preview_moves); otherwise, or if the token is stale, they
+		are committed with _commit_moves.
+		Args:
+			urlsafe_game_key: The urlsafe key of the Game
+			moves: A list of (guess, assess) pairs, where assess is
+				_assess_letter or _assess_word
+			state_token: The state_token of the last GameForm, if any
+			move_id: A client chosen id for the request, if any. A retry
+				with the same id gets the reply to the original request
+				instead of making the moves again
+		Returns:
+			The updated Game and the message for each guess that was applied."""
+		game_key = get_key_by_urlsafe(urlsafe_game_key, Game)
+		if state_token:
+			result = cls._preview_moves(game_key, moves, state_token, move_id)
+			if result:
+				return result
+		return cls._commit_moves(game_key, moves, move_id=move_id)
+
+	@classmethod
+	def _preview_moves(cls, game_key, moves, state_token, move_id=None):
+		"""Evaluates guesses against the state carried by a state token, with
+		no datastore read, and queues a task that commits the same guesses
+		from the same version. The moves are deterministic, so the task ends
+		up with the state returned here, and any Score and Ranking are written
+		by the task when the game ends. The task also records move_id, so a
+		retry that arrives while it is pending is refused as a conflict and
+		one that arrives later gets the same reply.
+		Returns:
+			The unsaved, updated Game and the message for each guess, or None
+			if the token is invalid or its version was already moved from."""
+		state = tokens.decode(game_key, state_token)
+		game = state and Game.from_state(game_key, state)
+		owner = uuid.uuid4().hex
+		if not game or tokens.claim(game_key, game.version, owner) is not True:
+			return None
+		from_state = tokens.digest(game.to_state())
+		ranking = Ranking(key=Ranking.key_for(game.user), user_name=game.user_name)
+		replies, entities, moved = cls._apply_moves(game, moves, ranking)
+		if not moved:
+			tokens.release(game_key, game.version, owner)
+			return game, replies
+		applied = [[guess, assess == cls._assess_word] for guess, assess in moves[:len(replies)]]
+		params = {"game_key": game_key.urlsafe(), "version": game.version, "moves": json.dumps(applied),
+				  "state": from_state}
+		if move_id:
+			params["move_id"] = move_id
+		try:
+			taskqueue.add(url="/tasks/commit_moves", queue_name="moves", params=params)
+		except Exception:
+			tokens.release(game_key, game.version, owner)
+			raise
+		game.version += 1
+		return game, replies
+
+	@classmethod
+	def commit_queued_moves(cls, game_key, version, moves, move_id=None, state=None):
+		"""Commits guesses queued by _preview_moves from a version of a game.
+		state is the digest of the state they were made from, if the task
+		carries one.
+		Raises:
+			tokens.OutOfOrder: if moves queued earlier have not been committed
+				yet, so that the task is retried"""
+		moves = [(guess, cls._assess_word if word else cls._assess_letter) for guess, word in moves]
+		cls._commit_moves(game_key, moves, version, move_id, state)
+
+	@classmethod
+	def _commit_moves(cls, game_key, moves, queued_version=None, move_id=None, queued_state=None):
+		"""Applies guesses to a game in a single transaction on the user's
+		entity group, retried a few times if it collides with another. The
+		Game and the user's Ranking are read with one batch get, and the Game
+		(with every move added to its inline history) and any Score and
+		Ranking from the end of the game are written with one put_multi. The
+		active game counters are updated once it commits. Moves made directly
+		claim the Game's version first, so they cannot overtake moves made
+		from a state token that are still queued. Queued moves were claimed
+		when they were made, and are only committed from the version and the
+		state (by digest) they were made from. A move_id already among the
+		Game's recent moves is answered from there without moving again.
+		Returns:
+			The updated Game and the message for each guess that was applied.
+		Raises:
+			endpoints.ConflictException: if every attempt collided with
+				another transaction"""
+		owner = uuid.uuid4().hex
+		claimed = []
+
+		def move():
+			game, ranking = ndb.get_multi([game_key, Ranking.key_for(game_key.parent())])
+			if not game:
+				# Archived games are finished, so no move will be made
+				game = GameArchive.get_game(game_key)
+			if not game:
+				raise endpoints.NotFoundException("Game not found. Start a new game!")
+			replies = game.find_move(move_id) if move_id else None
+			if queued_version is not None:
+				if game.version < queued_version:
+					raise tokens.OutOfOrder(game_key, queued_version)
+				if game.version > queued_version and (game.last_queued_version or -1) >= queued_version:
+					logging.info("Moves from version %d of %s are already committed", queued_version, game_key)
+					return game, [], False, game.attempts_remaining
+				if game.version > queued_version or (queued_state and tokens.digest(game.to_state()) != queued_state):
+					# The claim on a version was lost, so a direct move got
+					# there first. These moves, or the moves they were made
+					# after, can no longer be applied to the state the player saw
+					logging.error("Dropped moves %s from version %d of %s, which is at version %d",
+								  [guess for guess, assess in moves], queued_version, game_key, game.version)
+					stats.count("dropped_moves")
+					return game, [], False, game.attempts_remaining
+			elif replies is not None:
+				stats.count("duplicate_moves")
+				return game, replies, False, game.attempts_remaining
+			elif not game.game_over:
+				# Without memcache the claim is skipped, and the version check
+				# when queued moves are committed is all that remains
+				held = tokens.claim(game_key, game.version, owner)
+				if held is False:
+					raise endpoints.ConflictException("An earlier move is still being saved. Try again.")
+				if held:
+					claimed.append(game.version)
+			legacy_history = game.fold_history()
+			was_active, attempts_before = not game.game_over, game.attempts_remaining
+			replies, entities, moved = cls._apply_moves(game, moves, ranking)
+			if moved:
+				game.version += 1
+				if queued_version is not None:
+					game.last_queued_version = queued_version
+				if move_id:
+					game.remember_move(move_id, replies)
+				ndb.put_multi([game] + entities)
+				ndb.delete_multi(legacy_history)
+			return game, replies, was_active, attempts_before
+
+		try:
+			game, replies, was_active, attempts_before = run_in_transaction(move)
+		except Exception, e:
+			for version in claimed:
+				tokens.release(game_key, version, owner)
+			if isinstance(e, datastore_errors.TransactionFailedError):
+				raise endpoints.ConflictException("The game is busy. Try again.")
+			raise
+		if claimed and not game.version > claimed[-1]:
+			tokens.release(game_key, claimed[-1], owner)
+		if was_active and game.game_over:
+			update_active_games(-1, -attempts_before)
+		elif was_active:
+			update_active_games(0, game.attempts_remaining - attempts_before)
+		return game, replies
+
+	@staticmethod
+	def _apply_moves(game, moves, ranking):
+		"""Applies guesses to a game in place, stopping once it is over.
+		Returns:
+			The message for each guess applied, the extra entities to write
+			and whether any move was made."""
+		replies, entities, moved = [], [], False
+		for guess, assess in moves:
+			if game.game_over and replies:
+				break
+			message, end_entities = assess(game, guess, ranking)
+			replies.append(message)
+			if end_entities is not None:
+				moved = True
+				game.save_history(guess, message, game.guess_count)
+				entities.extend(end_entities)
+		return replies, entities, moved
+
+	@staticmethod
+	def _assess_letter(game, guess, ranking):
+		"""Assesses a letter guess, updating the game in place.
+		Returns:
+			The message for the player and the list of extra entities to write
+			with the move, or None in place of the list if no move was made."""
+		return _end_move(game, game.guess_letter(guess), ranking)
+
+	@staticmethod
+	def _assess_word(game, guess, ranking):
+		"""Assesses a whole word guess, updating the game in place.
+		Returns:
+			The message for the player and the list of extra entities to write
+			with the move, or None in place of the list if no move was made."""
+		return _end_move(game, game.guess_word(guess), ranking)
+
+
+def _end_move(game, outcome, ranking):
+	"""Turns the engine's Outcome of a guess into the message for the player
+	and the extra entities to write with the move, ending the game with its
+	Score if the guess finished it"""
+	if not outcome.moved:
+		return outcome.message, None
+	if outcome.finished:
+		return outcome.message, game.end_game(outcome.won, outcome.score, ranking)
+	return outcome.message, []
 
 api = endpoints.api_server([PokemonHangmanAPI])
@@ -15,41 +15,406 @@
 # limitations under the License.
 #
 """main.py - This file contains handlers that are called by taskqueue and cronjobs"""
+import endpoints
+import json
+import logging
 import webapp2
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from google.appengine.api import mail, app_identity
-from game import PokemonHangmanAPI
+from google.appengine.api import apiproxy_stub_map, api_base_pb
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
-from models import User, Game
+import cache
+import export
+import stats
+import tokens
+from counters import reconcile_active_games
+from game import PokemonHangmanAPI  # also registers the endpoint names reported by /admin/stats
+from models import User, UserEmail, Game, GameArchive, Ranking, PeriodScore, Leaderboard, ReminderSent, Migration
+from models import ARCHIVE_TIME_FORMAT, USER_MIGRATION
+from utils import get_cursor, run_in_transaction
+
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_TRANSACTION_SIZE = 25
+PRUNE_BATCH_SIZE = 500
+EXPORT_CHUNKS_PER_TASK = 20
+BACKFILL_BATCH_SIZE = 50
+MIGRATE_BATCH_SIZE = 100
+RECONCILE_BATCH_SIZE = 500
+REMINDER_BATCH_SIZE = 100
+REMINDER_PRUNE_SIZE = 500
+REMINDER_CLAIM_TIMEOUT = 24 * 60 * 60
+REMINDER_SEND_RETRIES = 3
+REMINDER_RETRY_DELAY = 5 * 60
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+	@stats.instrumented("send_reminder")
 	def get(self):
-		"""Send a reminder email to each User with an unfinished game.
-		Called every hour using a cron job"""
+		"""Start sending a reminder email to each User with an unfinished
+		game. Called every 24 hours using a cron job"""
+		today = date.today().isoformat()
+		taskqueue.add(url="/tasks/prune_reminders", params={"date": today})
+		taskqueue.add(url="/tasks/send_reminders", params={"date": today})
+
+
+class PruneReminderMarkers(webapp2.RequestHandler):
+	@stats.instrumented("prune_reminders")
+	def post(self):
+		"""Delete one batch of the ReminderSent markers from before the given
+		day, then queue the next"""
+		day = self.request.get("date")
+		before = datetime.strptime(day, "%Y-%m-%d").date()
+		keys = ReminderSent.query(ReminderSent.date < before).fetch(REMINDER_PRUNE_SIZE, keys_only=True)
+		ndb.delete_multi(keys)
+		if len(keys) == REMINDER_PRUNE_SIZE:
+			taskqueue.add(url="/tasks/prune_reminders", params={"date": day})
+		logging.info("Pruned %d reminder markers", len(keys))
+		self.response.set_status(204)
+
+
+class SendReminders(webapp2.RequestHandler):
+	@stats.instrumented("send_reminders")
+	def post(self):
+		"""Send reminders to the owners of one batch of unfinished games, or
+		retry the Users given in "users" whose reminders failed. The next
+		batch is queued first so that batches run in parallel, and each User
+		is only reminded once per day however many batches their games
+		appear in"""
+		day = self.request.get("date")
+		reminder_date = datetime.strptime(day, "%Y-%m-%d").date()
+		attempt = int(self.request.get("attempt") or 0)
+		if attempt:
+			user_keys = [ndb.Key(urlsafe=key) for key in self.request.get("users").split(",")]
+		else:
+			cursor = get_cursor(self.request.get("cursor"))
+			query = Game.query(Game.game_over == False)
+			game_keys, cursor, more = query.fetch_page(REMINDER_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+			if more and cursor:
+				taskqueue.add(url="/tasks/send_reminders", params={"date": day, "cursor": cursor.urlsafe()})
+			user_keys = list(set(key.parent() for key in game_keys))
+
+		marker_keys = [ReminderSent.key_for(user_key, day) for user_key in user_keys]
+		entities = ndb.get_multi(user_keys + marker_keys)
+		users, markers = entities[:len(user_keys)], entities[len(user_keys):]
+		pending = dict((marker_key.id(), user) for user, marker, marker_key in zip(users, markers, marker_keys)
+					   if user and user.email and not marker)
+		# memcache.add is atomic, so batches running at the same time cannot
+		# both claim a User. The datastore markers outlive memcache evictions.
+		# If memcache is down nobody is claimed, and only the markers guard
+		# against a second reminder.
+		claims = memcache.Client().add_multi_async(dict.fromkeys(pending, 1), time=REMINDER_CLAIM_TIMEOUT,
+												   namespace="reminders").get_result() or {}
+		for marker_id, status in claims.items():
+			if status in (memcache.NOT_STORED, memcache.EXISTS):
+				del pending[marker_id]
+
 		app_id = app_identity.get_application_id()
-		users = User.query(User.email != None)
+		rpcs = []
+		for marker_id, user in pending.items():
+			message = mail.EmailMessage(sender='noreply@{}.appspotmail.com'.format(app_id),
+										to=user.email,
+										subject='This is a reminder!',
+										body='Hello {}, you have an unfinished game of Pokemon Hangman!'.format(user.name))
+			# The mail API has no async send, so make the RPC directly to
+			# have every send in the batch in flight at once
+			rpc = apiproxy_stub_map.UserRPC("mail")
+			rpc.make_call("Send", message.ToProto(), api_base_pb.VoidProto())
+			rpcs.append((marker_id, user, rpc))
+		sent, failed = [], []
+		for marker_id, user, rpc in rpcs:
+			try:
+				rpc.check_success()
+				sent.append(marker_id)
+			except Exception:
+				logging.exception("Reminder to %s failed", user.name)
+				failed.append((marker_id, user))
+		# Only a sent reminder is marked, and a failed one gives up its claim
+		# so that it can be retried today
+		ndb.put_multi([ReminderSent(id=marker_id, date=reminder_date) for marker_id in sent])
+		if failed:
+			memcache.delete_multi([marker_id for marker_id, user in failed], namespace="reminders")
+			if attempt < REMINDER_SEND_RETRIES:
+				taskqueue.add(url="/tasks/send_reminders", countdown=REMINDER_RETRY_DELAY * 2 ** attempt,
+							  params={"date": day, "attempt": attempt + 1,
+									  "users": ",".join(user.key.urlsafe() for marker_id, user in failed)})
+
+		memcache.offset_multi({"scanned:" + day: 0 if attempt else len(user_keys), "sent:" + day: len(sent)},
+							  namespace="reminder_metrics", initial_value=0)
+		logging.info("Reminders: scanned %d users, sent %d emails, %d failed", len(user_keys), len(sent), len(failed))
+		self.response.set_status(204)
+
+
+class ReconcileActiveGames(webapp2.RequestHandler):
+	@stats.instrumented("reconcile_active_games_cron")
+	def get(self):
+		"""Start recounting the active games. Called every 6 hours using a
+		cron job"""
+		taskqueue.add(url="/tasks/reconcile_active_games")
+
+	@stats.instrumented("reconcile_active_games")
+	def post(self):
+		"""Add one batch of active games to the running totals, then queue
+		the next batch. After the last batch, correct any drift in the
+		sharded active game counters"""
+		cursor = get_cursor(self.request.get("cursor"))
+		games = int(self.request.get("games", 0))
+		attempts = int(self.request.get("attempts", 0))
+		query = Game.query(Game.game_over == False)
+		page, cursor, more = query.fetch_page(RECONCILE_BATCH_SIZE, start_cursor=cursor,
+											  projection=[Game.attempts_remaining])
+		games += len(page)
+		attempts += sum(game.attempts_remaining for game in page)
+		if more and cursor:
+			taskqueue.add(url="/tasks/reconcile_active_games",
+						  params={"cursor": cursor.urlsafe(), "games": games, "attempts": attempts})
+		else:
+			reconcile_active_games(games, attempts)
+		self.response.set_status(204)
+
+
+class BackfillRankings(webapp2.RequestHandler):
+	@stats.instrumented("backfill_rankings_start")
+	def get(self):
+		"""Start rebuilding every User's Ranking from their Scores"""
+		taskqueue.add(url="/tasks/backfill_rankings")
+		self.response.write("Ranking backfill started.")
+
+	@stats.instrumented("backfill_rankings")
+	def post(self):
+		"""Rebuild the Rankings of one batch of Users, then queue the next
+		batch from where this one left off"""
+		cursor = get_cursor(self.request.get("cursor"))
+		users, cursor, more = User.query().fetch_page(BACKFILL_BATCH_SIZE, start_cursor=cursor)
+		for user in users:
+			Ranking.rebuild(user)
+		if more and cursor:
+			taskqueue.add(url="/tasks/backfill_rankings", params={"cursor": cursor.urlsafe()})
+		self.response.set_status(204)
+
+
+class UpdateLeaderboard(webapp2.RequestHandler):
+	@stats.instrumented("update_leaderboard")
+	def post(self):
+		"""Add a new Score to the high score leaderboard. Queued when a game
+		ends with a score that may qualify"""
+		score = ndb.Key(urlsafe=self.request.get("score_key")).get()
+		if score:
+			Leaderboard.submit(score)
+		self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+	@stats.instrumented("migrate_users_start")
+	def get(self):
+		"""Start moving Users created before names became keys"""
+		taskqueue.add(url="/tasks/migrate_users")
+		self.response.write("User migration started.")
+
+	@stats.instrumented("migrate_users")
+	def post(self):
+		"""Migrate one batch of Users, then queue the next batch. Users who
+		could not be moved yet are counted, and once a pass ends with none
+		left the name query fallback in User.get_by_name is turned off"""
+		cursor = get_cursor(self.request.get("cursor"))
+		skipped = int(self.request.get("skipped") or 0)
+		users, cursor, more = User.query().fetch_page(MIGRATE_BATCH_SIZE, start_cursor=cursor)
 		for user in users:
-			user_games = Game.query(ancestor=user.key)
-			unfinished = user_games.filter(Game.game_over == False).get()
-			if unfinished:
-				subject = 'This is a reminder!'
-				body = 'Hello {}, you have an unfinished game of Pokemon Hangman!'.format(user.name)
-				# This will send test emails, the arguments to send_mail are:
-				# from, to, subject, body
-				mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-							   user.email,
-							   subject,
-							   body)
+			if user.key.id() != user.name and not self.migrate(user):
+				skipped += 1
+		if more and cursor:
+			taskqueue.add(url="/tasks/migrate_users", params={"cursor": cursor.urlsafe(), "skipped": skipped})
+		elif skipped:
+			logging.warning("%d Users were not migrated. Visit /tasks/migrate_users again later", skipped)
+		else:
+			Migration(id=USER_MIGRATION).put()
+		self.response.set_status(204)
+
+	@staticmethod
+	def migrate(user):
+		"""Re-keys a User by name, reserves their email, and moves every
+		entity in their entity group (Games, History, Scores and Ranking)
+		under the new key, repointing `user` properties. Users with an active
+		game are left for a later pass, since moving the game would change
+		the key its player is using. Each batch is moved in one transaction
+		with the entity group, so a game started meanwhile is not lost, and
+		each step can be safely repeated, so a retried task picks up where it
+		stopped.
+		Returns:
+			Whether the User was migrated"""
+		new_key = User.key_for(user.name)
+		new_user = new_key.get()
+		if new_user and new_user.email != user.email:
+			logging.warning("Cannot migrate User %s: the name is already taken", user.key.id())
+			return False
+		if Game.query(Game.game_over == False, ancestor=user.key).get(keys_only=True):
+			logging.info("Not migrating User %s yet: they have an active game", user.key.id())
+			return False
+		entities = [User(key=new_key, name=user.name, email=user.email)]
+		if user.email and not UserEmail.key_for(user.email).get():
+			entities.append(UserEmail(key=UserEmail.key_for(user.email), user=new_key))
+		ndb.put_multi(entities)
+
+		def move_batch():
+			batch = [entity for entity in ndb.Query(ancestor=user.key).fetch(MIGRATE_BATCH_SIZE)
+					 if entity.key != user.key]
+			if not batch:
+				user.key.delete()
+				return False
+			old_keys = []
+			for entity in batch:
+				old_keys.append(entity.key)
+				entity.key = ndb.Key(pairs=new_key.pairs() + entity.key.pairs()[1:])
+				if getattr(entity, "user", None) == user.key:
+					entity.user = new_key
+			ndb.put_multi(batch)
+			ndb.delete_multi(old_keys)
+			return True
+
+		while run_in_transaction(move_batch, xg=True):
+			pass
+		return True
+
+
+class ArchiveGames(webapp2.RequestHandler):
+	@stats.instrumented("archive_games_cron")
+	def get(self):
+		"""Start archiving the games finished more than ARCHIVE_AFTER_DAYS
+		ago. Called every day using a cron job"""
+		cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+		taskqueue.add(url="/tasks/archive_games", params={"cutoff": cutoff.strftime(ARCHIVE_TIME_FORMAT)})
+
+	@stats.instrumented("archive_games")
+	def post(self):
+		"""Archive the games finished before the cutoff in one batch of
+		finished games, then queue the next batch. Games finished by older
+		versions have no finish time; they are stamped now and archived
+		once that is old enough"""
+		cutoff = datetime.strptime(self.request.get("cutoff"), ARCHIVE_TIME_FORMAT)
+		cursor = get_cursor(self.request.get("cursor"))
+		query = Game.query(Game.game_over == True)
+		games, cursor, more = query.fetch_page(ARCHIVE_BATCH_SIZE, start_cursor=cursor)
+		if more and cursor:
+			taskqueue.add(url="/tasks/archive_games",
+						  params={"cutoff": self.request.get("cutoff"), "cursor": cursor.urlsafe()})
+
+		unstamped = [game for game in games if not game.finished]
+		for game in unstamped:
+			game.finished = datetime.now()
+		ndb.put_multi(unstamped)
+		periods = defaultdict(list)
+		for game in games:
+			if game.key.parent() and game.finished < cutoff:
+				periods[(game.key.parent(), game.finished.strftime("%Y-%m"))].append(game.key)
+		archived = 0
+		for (user_key, period), game_keys in periods.items():
+			for start in range(0, len(game_keys), ARCHIVE_TRANSACTION_SIZE):
+				archived += GameArchive.add(user_key, period, game_keys[start:start + ARCHIVE_TRANSACTION_SIZE])
+		logging.info("Archived %d of %d finished games", archived, len(games))
+		self.response.set_status(204)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class PrunePeriodScores(webapp2.RequestHandler):
+	@stats.instrumented("prune_period_scores_cron")
+	def get(self):
+		"""Start deleting the PeriodScores that have expired. Called every
+		day using a cron job"""
+		taskqueue.add(url="/tasks/prune_period_scores")
+
+	@stats.instrumented("prune_period_scores")
+	def post(self):
+		"""Delete one batch of expired PeriodScores, then queue the next"""
+		query = PeriodScore.query(PeriodScore.expires < date.today())
+		keys = query.fetch(PRUNE_BATCH_SIZE, keys_only=True)
+		ndb.delete_multi(keys)
+		if len(keys) == PRUNE_BATCH_SIZE:
+			taskqueue.add(url="/tasks/prune_period_scores")
+		logging.info("Pruned %d expired period scores", len(keys))
+		self.response.set_status(204)
+
+
+class CommitMoves(webapp2.RequestHandler):
+	@stats.instrumented("commit_moves")
 	def post(self):
-		"""Update game listing announcement in memcache."""
-		PokemonHangmanAPI._cache_average_attempts()
+		"""Commit guesses that were evaluated from a state token. While moves
+		queued before them are still pending, respond with an error so the
+		task is retried"""
+		game_key = ndb.Key(urlsafe=self.request.get("game_key"))
+		version = int(self.request.get("version"))
+		try:
+			PokemonHangmanAPI.commit_queued_moves(game_key, version, json.loads(self.request.get("moves")),
+												  self.request.get("move_id") or None, self.request.get("state") or None)
+		except tokens.OutOfOrder:
+			logging.info("Moves from version %d of %s are waiting for earlier moves", version, game_key)
+			self.response.set_status(409)
+			return
+		except endpoints.NotFoundException:
+			logging.warning("Game %s was deleted before its moves were committed", game_key)
 		self.response.set_status(204)
 
 
+class ExportData(webapp2.RequestHandler):
+	@stats.instrumented("export_start")
+	def get(self):
+		"""Start exporting scores, games or history as NDJSON or CSV to a sink
+		URL, or report the progress of an export given its id, as JSON.
+		Admin only"""
+		self.response.headers["Content-Type"] = "application/json"
+		if self.request.get("id"):
+			checkpoint = export.Export.get_by_id(self.request.get("id"))
+			if not checkpoint:
+				self.abort(404)
+		else:
+			try:
+				checkpoint = export.start(self.request.get("kind"), self.request.get("format", "ndjson"),
+										  self.request.get("sink"),
+										  int(self.request.get("batch_size") or export.BATCH_SIZE))
+			except ValueError, e:
+				self.abort(400, detail=str(e))
+			taskqueue.add(url="/tasks/export", params={"id": checkpoint.key.id()})
+		self.response.write(json.dumps(checkpoint.to_dict(), sort_keys=True))
+
+	@stats.instrumented("export")
+	def post(self):
+		"""Write the next chunks of an export from its checkpoint, then queue
+		the rest. A retried task resumes from the last chunk written"""
+		checkpoint = export.run(self.request.get("id"), EXPORT_CHUNKS_PER_TASK)
+		if checkpoint and not checkpoint.done:
+			taskqueue.add(url="/tasks/export", params={"id": checkpoint.key.id()})
+		elif checkpoint:
+			logging.info("Export %s finished: %d rows in %d chunks", checkpoint.key.id(), checkpoint.rows,
+						 checkpoint.chunks)
+		self.response.set_status(204)
+
+
+class Stats(webapp2.RequestHandler):
+	def get(self):
+		"""Report per-endpoint latency histograms and API RPC counts, and the
+		read-through cache hit and miss counts, as JSON. Admin only"""
+		self.response.headers["Content-Type"] = "application/json"
+		self.response.write(json.dumps({"endpoints": stats.get_stats(), "cache": cache.get_stats()},
+									   indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
 	('/crons/send_reminder', SendReminderEmail),
-	('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+	('/tasks/send_reminders', SendReminders),
+	('/tasks/prune_reminders', PruneReminderMarkers),
+	('/crons/reconcile_active_games', ReconcileActiveGames),
+	('/tasks/reconcile_active_games', ReconcileActiveGames),
+	('/tasks/backfill_rankings', BackfillRankings),
+	('/tasks/migrate_users', MigrateUsers),
+	('/tasks/update_leaderboard', UpdateLeaderboard),
+	('/tasks/commit_moves', CommitMoves),
+	('/crons/archive_games', ArchiveGames),
+	('/tasks/archive_games', ArchiveGames),
+	('/crons/prune_period_scores', PrunePeriodScores),
+	('/tasks/prune_period_scores', PrunePeriodScores),
+	('/tasks/export', ExportData),
+	('/admin/export', ExportData),
+	('/admin/stats', Stats),
 ], debug=True)
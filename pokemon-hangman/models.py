@@ -1,114 +1,661 @@
 """models.py - Contains all Datastore models and ProtoRPC messages for the game"""
 
+import json
 import random
+import time
+import zlib
+import cache
+import engine
+import tokens
 from utils import PokemonNames
-from datetime import date
+from datetime import date, datetime, timedelta
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 POKEMON_LIST = PokemonNames()
+ARCHIVE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+USER_MIGRATION = "users_by_name"
+MIGRATION_CHECK_INTERVAL = 60
+
+_finished_migrations = set()
+_migration_checks = {}
+
+
+def _user_names(entities):
+	"""Returns a dict mapping user keys to user names for the given entities.
+	Names denormalized onto the entities are used as-is, any remaining users
+	are resolved with a single batch get"""
+	names = dict((entity.user, entity.user_name) for entity in entities if entity.user_name)
+	missing = list(set(entity.user for entity in entities) - set(names))
+	for user in ndb.get_multi(missing):
+		if user:
+			names[user.key] = user.name
+	return names
 
 class User(ndb.Model):
-	"""User profile object"""
+	"""User profile object, keyed by the user's name"""
 	name = ndb.StringProperty(required=True)
-	email = ndb.StringProperty()
+	email = ndb.StringProperty(indexed=False)
 
-	def to_form(self, total_score):
-		form = UserForm()
-		form.user_name = self.name
-		form.total_score = total_score
+	@classmethod
+	def key_for(cls, name):
+		"""Returns the key of the User with a name"""
+		return ndb.Key(cls, name)
+
+	@classmethod
+	def get_by_name(cls, name):
+		"""Returns the User with a name, or None, reading through the cache"""
+		return cls.get_by_name_async(name).get_result()
+
+	@classmethod
+	@ndb.tasklet
+	def get_by_name_async(cls, name):
+		"""Tasklet version of get_by_name"""
+		user = yield cache.get_async(cls.key_for(name))
+		if user is None:
+			migrated = yield Migration.is_finished_async(USER_MIGRATION)
+			if not migrated:
+				# Users created before names became keys, until they are migrated
+				key = cache.get_user_key(name, lambda name: cls.query(cls.name == name).get(keys_only=True))
+				if key:
+					user = yield cache.get_async(key)
+		raise ndb.Return(user)
+
+	@classmethod
+	@ndb.transactional(xg=True)
+	def create(cls, name, email):
+		"""Creates a User keyed by name, along with their empty Ranking and a
+		UserEmail marker that reserves their email, in one cross-group
+		transaction.
+		Raises:
+			ValueError: if the name or the email is already taken"""
+		keys = [cls.key_for(name)]
+		if email:
+			keys.append(UserEmail.key_for(email))
+		taken = ndb.get_multi(keys)
+		if taken[0]:
+			raise ValueError("A User with that name already exists!")
+		if email and taken[1]:
+			raise ValueError("A User with that email already exists!")
+		user = cls(key=keys[0], name=name, email=email)
+		entities = [user, Ranking(key=Ranking.key_for(user.key), user_name=name)]
+		if email:
+			entities.append(UserEmail(key=keys[1], user=user.key))
+		ndb.put_multi(entities)
+		return user
+
+	def _post_put_hook(self, future):
+		cache.invalidate(self.key)
+
+	@classmethod
+	def _post_delete_hook(cls, key, future):
+		cache.invalidate(key)
+
+
+class Migration(ndb.Model):
+	"""Marks that a data migration has finished, keyed by its name"""
+	finished = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+	@classmethod
+	@ndb.tasklet
+	def is_finished_async(cls, name):
+		"""Returns whether a migration has finished. Once it has, the answer
+		is kept for the life of the instance, and until then the marker is
+		read at most every MIGRATION_CHECK_INTERVAL seconds"""
+		if name in _finished_migrations:
+			raise ndb.Return(True)
+		if time.time() - _migration_checks.get(name, 0) < MIGRATION_CHECK_INTERVAL:
+			raise ndb.Return(False)
+		_migration_checks[name] = time.time()
+		marker = yield cls.get_by_id_async(name)
+		if marker:
+			_finished_migrations.add(name)
+		raise ndb.Return(marker is not None)
+
+
+class UserEmail(ndb.Model):
+	"""Reserves an email address for one User, keyed by the email"""
+	user = ndb.KeyProperty(required=True, kind="User", indexed=False)
+
+	@classmethod
+	def key_for(cls, email):
+		return ndb.Key(cls, email)
+
+
+class History(ndb.Model):
+	"""Object representing a past guess and result. Stored inline on its
+	Game; older games may still have these as separate child entities"""
+	guess = ndb.StringProperty(required=True, indexed=False)
+	message = ndb.StringProperty(required=True, indexed=False)
+	order = ndb.IntegerProperty(required=True, indexed=False)
+
+	def to_form(self):
+		form = HistoryForm()
+		form.guess = self.guess
+		form.message = self.message
 		return form
 
 
 class Game(ndb.Model):
-	"""Game object"""
-	user = ndb.KeyProperty(required=True, kind="User")
-	word = ndb.StringProperty(required=True)
-	word_so_far = ndb.StringProperty(required=True)
+	"""Game object. The guesses are kept as a bitmask of the letters a-z
+	guessed plus a list of every other guess (whole words and symbols such as
+	'.' or '-'), and word_so_far is rendered from a bitmask of the revealed
+	positions. Only game_over and attempts_remaining are indexed, for the
+	reminder and reconcile queries. The rules live in engine.py"""
+	RECENT_MOVES = 10
+	user = ndb.KeyProperty(required=True, kind="User", indexed=False)
+	user_name = ndb.StringProperty(indexed=False)
+	word = ndb.StringProperty(required=True, indexed=False)
 	attempts_remaining = ndb.IntegerProperty(required=True, default=6)
-	past_guesses = ndb.StringProperty(repeated=True)
+	guessed_letters = ndb.IntegerProperty(indexed=False)
+	guessed_words = ndb.StringProperty(repeated=True, indexed=False)
+	revealed = ndb.IntegerProperty(indexed=False)
 	game_over = ndb.BooleanProperty(required=True, default=False)
-	penalty = ndb.FloatProperty(required=True, default=0.0)
+	penalty = ndb.FloatProperty(required=True, default=0.0, indexed=False)
+	history = ndb.LocalStructuredProperty(History, repeated=True)
+	history_inline = ndb.BooleanProperty(default=False, indexed=False)
+	# Incremented by every committed move, so stale state tokens are rejected
+	version = ndb.IntegerProperty(default=0, indexed=False)
+	# The version the last moves queued from a state token were committed
+	# from, so a retried task can tell its moves were saved from dropped
+	last_queued_version = ndb.IntegerProperty(indexed=False)
+	finished = ndb.DateTimeProperty(indexed=False)
+	# [move_id, replies] of the last RECENT_MOVES moves sent with a move_id,
+	# so a retried request gets the original reply instead of moving again
+	recent_moves = ndb.JsonProperty(indexed=False)
+	# Written by older versions. Read once to build the bitmasks and cleared,
+	# so the next put drops them
+	legacy_word_so_far = ndb.StringProperty("word_so_far", indexed=False)
+	legacy_past_guesses = ndb.StringProperty("past_guesses", repeated=True, indexed=False)
 
 	@classmethod
-	def new_game(cls, user):
+	def new_game(cls, user, user_name):
 		"""Creates and returns a new game"""
 		word = POKEMON_LIST.get_random_name()
-		word_so_far = "_" * len(word)
 		game = Game(parent=user,
 					user=user,
+					user_name=user_name,
 					word=word,
-					word_so_far=word_so_far,
-					attempts_remaining=6,
-					game_over=False)
+					attempts_remaining=engine.ATTEMPTS,
+					guessed_letters=0,
+					revealed=0,
+					game_over=False,
+					history_inline=True)
 		game.put()
 		return game
 
+	def upgrade_state(self):
+		"""Builds the bitmask state of a game stored by an older version from
+		its past_guesses list and word_so_far string. The change is saved with
+		the next put of the Game"""
+		if self.guessed_letters is not None:
+			return
+		self.guessed_letters, self.guessed_words, self.revealed = 0, [], 0
+		for guess in self.legacy_past_guesses:
+			engine.add_guess(self, guess)
+		for i, ltr in enumerate(self.legacy_word_so_far or ""):
+			if ltr != engine.BLANK:
+				self.revealed |= 1 << i
+		self.legacy_past_guesses, self.legacy_word_so_far = [], None
+
+	@property
+	def word_so_far(self):
+		"""The word with every position not yet revealed blanked out"""
+		self.upgrade_state()
+		return engine.word_so_far(self)
+
+	@property
+	def past_guesses(self):
+		"""The lowercased guesses made so far: the letters a-z in alphabetical
+		order, then every other guess in the order it was made"""
+		self.upgrade_state()
+		return engine.past_guesses(self)
+
+	@property
+	def guess_count(self):
+		"""The number of guesses made so far"""
+		self.upgrade_state()
+		return bin(self.guessed_letters).count("1") + len(self.guessed_words)
+
+	def guess_letter(self, guess):
+		"""Applies a letter guess with the engine's rules.
+		Returns:
+			An engine.Outcome."""
+		self.upgrade_state()
+		return engine.guess_letter(self, guess, POKEMON_LIST.get_word_index(self.word))
+
+	def guess_word(self, guess):
+		"""Applies a whole word guess with the engine's rules.
+		Returns:
+			An engine.Outcome."""
+		self.upgrade_state()
+		return engine.guess_word(self, guess, POKEMON_LIST.get_word_index(self.word))
+
 	def save_history(self, guess, message, order):
-		"""Saves the last made move to history"""
-		move = History(parent=self.key,
-					   guess=guess,
+		"""Adds the last made move to the Game's history. It is saved with
+		the next put of the Game"""
+		move = History(guess=guess,
 					   message=message,
 					   order=order)
-		move.put()
+		self.history.append(move)
 		return move
 
-	def to_form(self, message):
-		"""Returns a GameForm representation of the Game"""
+	def fold_history(self):
+		"""Moves History stored as separate child entities by older versions
+		into the Game's inline history. Must be called in a transaction that
+		also puts the Game.
+		Returns:
+			The keys of the folded History entities, which must be deleted in
+			the same transaction."""
+		if self.history_inline:
+			return []
+		moves = History.query(ancestor=self.key).fetch()
+		moves.sort(key=lambda move: move.order)
+		self.history = [History(guess=move.guess, message=move.message, order=move.order)
+						for move in moves] + self.history
+		self.history_inline = True
+		return [move.key for move in moves]
+
+	@classmethod
+	@ndb.transactional
+	def migrate_history(cls, key):
+		"""Folds a game's History child entities into the Game.
+		Returns:
+			The updated Game."""
+		game = key.get()
+		legacy = game.fold_history()
+		game.put()
+		ndb.delete_multi(legacy)
+		return game
+
+	def to_form(self, message, user_name=None, with_token=True):
+		"""Returns a GameForm representation of the Game. Active games get a
+		state token unless with_token is False"""
 		form = GameForm()
 		form.urlsafe_key = self.key.urlsafe()
-		form.user_name = self.user.get().name
+		form.user_name = user_name or self.user_name or self.user.get().name
 		form.attempts_remaining = self.attempts_remaining
 		form.game_over = self.game_over
 		form.message = message
 		form.word_so_far = self.word_so_far
+		if with_token and not self.game_over and self.user_name:
+			form.state_token = tokens.encode(self.key, self.to_state())
 		return form
 
-	def end_game(self, won=False, score=0):
+	def find_move(self, move_id):
+		"""Returns the messages of a recent move made with a move_id, or None"""
+		for recorded, replies in self.recent_moves or []:
+			if recorded == move_id:
+				return replies
+		return None
+
+	def remember_move(self, move_id, replies):
+		"""Records the messages of a move made with a move_id"""
+		self.recent_moves = ((self.recent_moves or []) + [[move_id, replies]])[-self.RECENT_MOVES:]
+
+	def to_state(self):
+		"""Returns the state of an active game, for a state token"""
+		self.upgrade_state()
+		return {"v": self.version, "n": self.user_name, "w": self.word, "a": self.attempts_remaining,
+				"p": self.penalty, "l": self.guessed_letters, "g": self.guessed_words, "r": self.revealed}
+
+	@classmethod
+	def from_state(cls, key, state):
+		"""Returns an unsaved Game with the state from a state token, or None
+		if the state is malformed"""
+		try:
+			return cls(key=key, user=key.parent(), user_name=state["n"], word=state["w"],
+					   attempts_remaining=state["a"], penalty=state["p"], guessed_letters=state["l"],
+					   guessed_words=state["g"], revealed=state["r"], version=state["v"],
+					   game_over=False, history_inline=True)
+		except (KeyError, TypeError, ValueError, datastore_errors.BadValueError):
+			return None
+
+	def to_archive(self):
+		"""Returns a finished game, with its history, as a JSON serializable
+		dict for a GameArchive"""
+		record = self.to_state()
+		record.update(u=self.user.urlsafe(), f=(self.finished or datetime.now()).strftime(ARCHIVE_TIME_FORMAT),
+					  h=[[move.guess, move.message, move.order] for move in self.history])
+		return record
+
+	@classmethod
+	def from_archive(cls, key, record):
+		"""Returns an unsaved, finished Game from its GameArchive record"""
+		game = cls.from_state(key, record)
+		game.user = ndb.Key(urlsafe=record["u"])
+		game.game_over = True
+		game.finished = datetime.strptime(record["f"], ARCHIVE_TIME_FORMAT)
+		game.history = [History(guess=guess, message=message, order=order) for guess, message, order in record["h"]]
+		return game
+
+	@classmethod
+	def get_with_archive(cls, key):
+		"""Returns the Game for a key, read from its GameArchive if it is no
+		longer live, or None. Games are not kept in the in-process cache,
+		since every move changes them and only ndb's memcache copy is
+		cleared on every instance when one is put"""
+		return key.get() or GameArchive.get_game(key)
+
+	def end_game(self, won=False, score=0, ranking=None):
+		"""Ends the game. Returns the new Score and the User's updated
+		Ranking and PeriodScores, which must be put in the same transaction
+		as the Game. If the score may make the high score leaderboard, a task
+		to add it is queued in that transaction. Outside of a transaction, as
+		when a move is previewed from a state token, nothing is queued and the
+		PeriodScores are left for the commit to update"""
 		self.game_over = True
-		self.put()
-		score = Score(parent=self.user, user=self.user, date=date.today(), won=won, score=score)
-		score.put()
+		self.finished = datetime.now()
+		if not self.user_name:
+			self.user_name = self.user.get().name
+		if not ranking:
+			ranking = Ranking(key=Ranking.key_for(self.user), user_name=self.user_name)
+		ranking.add_score(won, score)
+		# One Score per Game, so it shares the Game's id
+		score = Score(parent=self.user, id=self.key.id(), user=self.user, user_name=self.user_name,
+					  date=date.today(), won=won, score=score)
+		if ndb.in_transaction() and Leaderboard.qualifies(score.score):
+			taskqueue.add(url="/tasks/update_leaderboard", params={"score_key": score.key.urlsafe()},
+						  transactional=True)
+		entities = [score, ranking]
+		if ndb.in_transaction():
+			entities.extend(PeriodScore.add_scores(self.user, self.user_name, score.date, won, score.score))
+		return entities
 
 
 class Score(ndb.Model):
 	"""Score object"""
-	user = ndb.KeyProperty(required=True, kind="User")
+	user = ndb.KeyProperty(required=True, kind="User", indexed=False)
+	user_name = ndb.StringProperty(indexed=False)
 	date = ndb.DateProperty(required=True)
-	won = ndb.BooleanProperty(required=True)
+	won = ndb.BooleanProperty(required=True, indexed=False)
 	score = ndb.FloatProperty(required=True)
 
-	def to_form(self):
+	def to_form(self, user_name=None):
 		form = ScoreForm()
-		form.user_name = self.user.get().name
+		form.user_name = user_name or self.user_name or self.user.get().name
 		form.won = self.won
 		form.date = str(self.date)
 		form.score = self.score
 		return form
 
+	@ndb.tasklet
+	def to_form_async(self):
+		"""Tasklet version of to_form. Lookups of the users of Scores without
+		a denormalized name are batched together by ndb, so it can be mapped
+		over a query"""
+		user_name = self.user_name
+		if not user_name:
+			user = yield self.user.get_async()
+			user_name = user.name
+		raise ndb.Return(self.to_form(user_name))
 
-class History(ndb.Model):
-	"""Object representing a past guess and result"""
-	guess = ndb.StringProperty(required=True)
-	message = ndb.StringProperty(required=True)
-	order = ndb.IntegerProperty(required=True)
+	@classmethod
+	def to_forms(cls, scores):
+		"""Returns a ScoreForms representation of the Scores, resolving all of
+		their users at once"""
+		names = _user_names(scores)
+		return ScoreForms(items=[score.to_form(names.get(score.user)) for score in scores])
+
+
+class LeaderboardEntry(ndb.Model):
+	"""One of the top scores, with its user's name denormalized"""
+	score_key = ndb.KeyProperty(required=True, kind="Score")
+	user_name = ndb.StringProperty(required=True)
+	date = ndb.DateProperty(required=True)
+	won = ndb.BooleanProperty(required=True)
+	score = ndb.FloatProperty(required=True)
 
 	def to_form(self):
-		form = HistoryForm()
-		form.guess = self.guess
-		form.message = self.message
+		return ScoreForm(user_name=self.user_name, date=str(self.date), won=self.won, score=self.score)
+
+
+class Leaderboard(ndb.Model):
+	"""The top SIZE scores, kept in a single entity mirrored in memcache so
+	that reading the high scores needs no query"""
+	SIZE = 100
+	KEY_NAME = "high_scores"
+	MEMCACHE_KEY = "LEADERBOARD"
+	entries = ndb.LocalStructuredProperty(LeaderboardEntry, repeated=True)
+
+	@classmethod
+	def get_entries(cls):
+		"""Returns the top scores, highest first, from memcache if possible.
+		The Leaderboard is built from the Scores on first use"""
+		entries = memcache.get(cls.MEMCACHE_KEY)
+		if entries is None:
+			board = cls.get_by_id(cls.KEY_NAME) or cls._build()
+			entries = board.entries
+			memcache.set(cls.MEMCACHE_KEY, entries)
+		return entries
+
+	@classmethod
+	def qualifies(cls, score):
+		"""Returns whether a score may make the leaderboard, judged from the
+		memcache mirror without touching the datastore"""
+		entries = memcache.get(cls.MEMCACHE_KEY)
+		return entries is None or len(entries) < cls.SIZE or score > entries[-1].score
+
+	@classmethod
+	def submit(cls, score):
+		"""Adds a Score to the leaderboard if it qualifies and is not already
+		on it, then clears the memcache mirror. Setting the mirror instead
+		could let a slower submit overwrite a newer board with its own"""
+		if cls._add(score):
+			memcache.delete(cls.MEMCACHE_KEY)
+
+	@classmethod
+	@ndb.transactional
+	def _add(cls, score):
+		"""Returns whether the Score was added"""
+		board = cls.get_by_id(cls.KEY_NAME) or cls(id=cls.KEY_NAME)
+		if any(entry.score_key == score.key for entry in board.entries):
+			return False
+		if len(board.entries) >= cls.SIZE and score.score <= board.entries[-1].score:
+			return False
+		board.entries.append(cls._entry(score, score.user_name))
+		board.entries.sort(key=lambda entry: -entry.score)
+		del board.entries[cls.SIZE:]
+		board.put()
+		return True
+
+	@classmethod
+	def _build(cls):
+		"""Creates the leaderboard from the highest existing Scores, unless
+		another request already has"""
+		scores = Score.query().order(-Score.score).fetch(cls.SIZE)
+		names = _user_names(scores)
+		return cls.get_or_insert(cls.KEY_NAME,
+								 entries=[cls._entry(score, names.get(score.user)) for score in scores])
+
+	@staticmethod
+	def _entry(score, user_name):
+		return LeaderboardEntry(score_key=score.key, user_name=user_name, date=score.date,
+								won=score.won, score=score.score)
+
+
+class ScoreTotals(ndb.Model):
+	"""The total score, games played and wins of a User's finished games,
+	shared by their Ranking and PeriodScores"""
+	user_name = ndb.StringProperty(required=True, indexed=False)
+	total_score = ndb.FloatProperty(required=True, default=0.0)
+	games_played = ndb.IntegerProperty(required=True, default=0, indexed=False)
+	wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+	def add_score(self, won, score):
+		self.total_score += score
+		self.games_played += 1
+		if won:
+			self.wins += 1
+
+	def to_form(self):
+		form = UserForm()
+		form.user_name = self.user_name
+		form.total_score = self.total_score
+		form.games_played = self.games_played
+		form.wins = self.wins
 		return form
 
 
+class Ranking(ScoreTotals):
+	"""Running totals of a User's finished games. Stored as a child of the
+	User so it can be updated in the same transaction as each Score"""
+
+	@classmethod
+	def key_for(cls, user):
+		"""Returns the key of the Ranking for the given user key"""
+		return ndb.Key(cls, "ranking", parent=user)
+
+	@classmethod
+	@ndb.transactional
+	def rebuild(cls, user):
+		"""Recomputes a User's Ranking and unexpired PeriodScores from all of
+		their Scores"""
+		ranking = cls(key=cls.key_for(user.key), user_name=user.name)
+		buckets = {}
+		for score in Score.query(ancestor=user.key):
+			ranking.add_score(score.won, score.score)
+			for bucket in PeriodScore.buckets_for(user.key, user.name, score.date, buckets):
+				bucket.add_score(score.won, score.score)
+		ndb.put_multi([ranking] + [bucket for bucket in buckets.values() if bucket.expires >= date.today()])
+		return ranking
+
+
+class PeriodScore(ScoreTotals):
+	"""A User's totals for the games finished in one day, ISO week or month.
+	A child of the User keyed by its period ("day:2016-05-31", "week:2016-W22"
+	or "month:2016-05"), so the buckets of the current periods are updated in
+	the same transaction as each Score. A window's leaderboard is a single
+	query on one period. Buckets are pruned RETENTION days after their
+	period ends"""
+	WINDOWS = ("day", "week", "month")
+	RETENTION = {"day": 7, "week": 28, "month": 366}
+	period = ndb.StringProperty(required=True)
+	expires = ndb.DateProperty(required=True)
+
+	@staticmethod
+	def periods(day):
+		"""Returns the day, week and month periods containing a date, each
+		with the last day of the period"""
+		year, week, weekday = day.isocalendar()
+		next_month = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+		return [("day:" + day.isoformat(), day),
+				("week:{}-W{:02d}".format(year, week), day + timedelta(days=7 - weekday)),
+				("month:" + day.strftime("%Y-%m"), next_month - timedelta(days=1))]
+
+	@classmethod
+	def period_for(cls, window, day):
+		"""Returns the period of a window ("day", "week" or "month") that
+		contains a date"""
+		return cls.periods(day)[cls.WINDOWS.index(window)][0]
+
+	@classmethod
+	def buckets_for(cls, user, user_name, day, buckets):
+		"""Returns the User's buckets for the periods containing a date, taken
+		from buckets, a dict of key to bucket, or created and added to it"""
+		result = []
+		for period, ends in cls.periods(day):
+			key = ndb.Key(cls, period, parent=user)
+			if key not in buckets:
+				window = period.split(":")[0]
+				buckets[key] = cls(key=key, period=period, user_name=user_name,
+								   expires=ends + timedelta(days=cls.RETENTION[window]))
+			result.append(buckets[key])
+		return result
+
+	@classmethod
+	def add_scores(cls, user, user_name, day, won, score):
+		"""Adds a finished game to the User's buckets for the periods
+		containing day, reading the existing buckets with one batch get.
+		Returns the updated buckets, to be put in the same transaction"""
+		keys = [ndb.Key(cls, period, parent=user) for period, ends in cls.periods(day)]
+		buckets = dict((bucket.key, bucket) for bucket in ndb.get_multi(keys) if bucket)
+		result = cls.buckets_for(user, user_name, day, buckets)
+		for bucket in result:
+			bucket.add_score(won, score)
+		return result
+
+
+class ReminderSent(ndb.Model):
+	"""Marks that a User was sent a reminder email on a day"""
+	date = ndb.DateProperty(required=True)
+
+	@classmethod
+	def key_for(cls, user, day):
+		"""Returns the marker key for a user key and an ISO format day"""
+		return ndb.Key(cls, "{}:{}".format(day, user.urlsafe()))
+
+
+class GameArchive(ndb.Model):
+	"""The finished Games of one User from one month, with their history,
+	compacted into a single zlib compressed JSON record. A child of the User
+	keyed by the month ("2016-05"), with further parts ("2016-05.2") if a
+	month outgrows MAX_SIZE. game_ids lets a Game be found by its key"""
+	MAX_SIZE = 900000
+	game_ids = ndb.IntegerProperty(repeated=True)
+	data = ndb.BlobProperty(required=True)
+
+	def get_records(self):
+		"""Returns a dict mapping the string ids of the archived Games to
+		their records"""
+		return json.loads(zlib.decompress(self.data))
+
+	@classmethod
+	def get_game(cls, key):
+		"""Returns the archived Game for a key, or None"""
+		if not key.parent() or not isinstance(key.id(), (int, long)):
+			return None
+		archive = cls.query(cls.game_ids == key.id(), ancestor=key.parent()).get()
+		record = archive and archive.get_records().get(str(key.id()))
+		return record and Game.from_archive(key, record)
+
+	@classmethod
+	@ndb.transactional
+	def add(cls, user, period, game_keys):
+		"""Moves finished Games of one User into the archive for a period and
+		deletes them, with any History child entities, in one transaction.
+		Games that are gone or were not finished are skipped.
+		Returns:
+			The number of Games archived."""
+		games = [game for game in ndb.get_multi(game_keys) if game and game.game_over]
+		if not games:
+			return 0
+		legacy_history = []
+		records = {}
+		for game in games:
+			legacy_history.extend(game.fold_history())
+			records[str(game.key.id())] = game.to_archive()
+		part = 1
+		while True:
+			key = ndb.Key(cls, period if part == 1 else "{}.{}".format(period, part), parent=user)
+			archive = key.get()
+			stored = archive.get_records() if archive else {}
+			stored.update(records)
+			data = zlib.compress(json.dumps(stored, separators=(",", ":")), 9)
+			if len(data) <= cls.MAX_SIZE or not archive:
+				break
+			part += 1
+		cls(key=key, game_ids=sorted(int(game_id) for game_id in stored), data=data).put()
+		ndb.delete_multi([game.key for game in games] + legacy_history)
+		return len(games)
+
+
 class UserForm(messages.Message):
 	"""UserForm for outbound user information"""
 	user_name = messages.StringField(1, required=True)
 	total_score = messages.FloatField(2, required=True)
+	games_played = messages.IntegerField(3)
+	wins = messages.IntegerField(4)
 
 
 class UserForms(messages.Message):
 	"""Returns multiple UserForms"""
 	items = messages.MessageField(UserForm, 1, repeated=True)
+	next_cursor = messages.StringField(2)
+	more = messages.BooleanField(3)
 
 
 class GameForm(messages.Message):
@@ -119,10 +666,13 @@ class GameForm(messages.Message):
 	message = messages.StringField(4, required=True)
 	user_name = messages.StringField(5, required=True)
 	word_so_far = messages.StringField(6, required=True)
+	state_token = messages.StringField(7)
 
 class GameForms(messages.Message):
 	"""Return multiple GameForms"""
 	items = messages.MessageField(GameForm, 1, repeated=True)
+	next_cursor = messages.StringField(2)
+	more = messages.BooleanField(3)
 
 
 class NewGameForm(messages.Message):
@@ -133,6 +683,38 @@ class NewGameForm(messages.Message):
 class GuessForm(messages.Message):
 	"""Form to guess a letter in the word"""
 	guess = messages.StringField(1, required=True)
+	state_token = messages.StringField(2)
+	move_id = messages.StringField(3)
+
+
+class BatchGuessForm(messages.Message):
+	"""One guess in a GuessBatchForm, of a letter or of the whole word"""
+	guess = messages.StringField(1, required=True)
+	word = messages.BooleanField(2, default=False)
+
+
+class GuessBatchForm(messages.Message):
+	"""Form to make several guesses in order"""
+	guesses = messages.MessageField(BatchGuessForm, 1, repeated=True)
+	state_token = messages.StringField(2)
+	move_id = messages.StringField(3)
+
+
+class GuessBatchResultForm(messages.Message):
+	"""Outbound game state after a batch of guesses, with the message for
+	each guess applied"""
+	game = messages.MessageField(GameForm, 1, required=True)
+	move_messages = messages.StringField(2, repeated=True)
+
+
+class HintForm(messages.Message):
+	"""Outbound suggestion for the next guess in a game. letter is set while
+	several Pokemon fit the game, and word once only one does"""
+	message = messages.StringField(1, required=True)
+	letter = messages.StringField(2)
+	word = messages.StringField(3)
+	candidates = messages.IntegerField(4)
+	entropy = messages.FloatField(5)
 
 
 class ScoreForm(messages.Message):
@@ -146,6 +728,8 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
 	"""Return multiple ScoreForms"""
 	items = messages.MessageField(ScoreForm, 1, repeated=True)
+	next_cursor = messages.StringField(2)
+	more = messages.BooleanField(3)
 
 
 class HistoryForm(messages.Message):
@@ -157,6 +741,8 @@ class HistoryForm(messages.Message):
 class HistoryForms(messages.Message):
 	"""Returns multiple HistoryForms"""
 	items = messages.MessageField(HistoryForm, 1, repeated=True)
+	next_cursor = messages.StringField(2)
+	more = messages.BooleanField(3)
 
 
 class StringMessage(messages.Message):
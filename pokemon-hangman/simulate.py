@@ -0,0 +1,222 @@
+"""simulate.py - Plays Pokemon Hangman in bulk with the game engine.
+
+Games against random names are split into chunks and played across every
+core with multiprocessing, under the rules and scoring in engine.py. Reports
+games per second, the win rate, guesses per game and the distribution of
+scores, so a scoring change can be evaluated before it ships.
+
+A strategy is a function that takes the list of names and a random.Random
+and returns a guesser. The guesser is called with an engine.State and
+returns a (guess, is_word) pair, or None to give up. The built in strategies
+are listed in STRATEGIES, and any other can be named as module:function.
+
+Usage:
+	python simulate.py --games 1000000 --strategy frequency
+	python simulate.py --strategy mystrategies:greedy --processes 4
+"""
+
+from __future__ import division, print_function
+import argparse
+import importlib
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter, defaultdict
+
+import engine
+from wordstore import WordStore
+
+NAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "names.txt")
+CHUNK_SIZE = 10000
+
+
+def random_letters(words, rng):
+	"""Guesses the letters a-z not guessed yet in random order"""
+	def guess(game):
+		letters = [ltr for ltr in engine.LETTERS if not game.guessed_letters & engine.letter_bit(ltr)]
+		return (rng.choice(letters), False) if letters else None
+	return guess
+
+
+def frequency(words, rng):
+	"""Guesses the letters a-z in order of how many names contain them"""
+	counts = Counter(ltr for word in words for ltr in set(word.lower()) if engine.letter_bit(ltr))
+	order = sorted(engine.LETTERS, key=lambda ltr: -counts[ltr])
+
+	def guess(game):
+		for ltr in order:
+			if not game.guessed_letters & engine.letter_bit(ltr):
+				return ltr, False
+		return None
+	return guess
+
+
+def candidates(words, rng):
+	"""Narrows the names down to those that fit what the game shows. Guesses
+	the name once only one fits, and otherwise the symbol most of them
+	contain"""
+	by_length = defaultdict(list)
+	for word in set(word.lower() for word in words):
+		by_length[len(word)].append((word, engine.letter_masks(word)))
+
+	def guess(game):
+		shown = engine.letter_masks(engine.word_so_far(game).lower())
+		guessed = [past for past in engine.past_guesses(game) if len(past) == 1]
+		fits = [word for word, masks in by_length[len(game.word)]
+				if word not in game.guessed_words
+				and all(masks.get(symbol, 0) == shown.get(symbol, 0) for symbol in guessed)]
+		if len(fits) == 1:
+			return fits[0], True
+		counts = Counter(symbol for word in fits for symbol in set(word) if symbol not in guessed)
+		if not counts:
+			return None
+		return counts.most_common(1)[0][0], False
+	return guess
+
+
+def solver(words, rng):
+	"""Takes the hint endpoint's suggestion. Needs NumPy"""
+	from solver import CandidateIndex
+	index = CandidateIndex(words)
+
+	def guess(game):
+		hint = index.hint(engine.word_so_far(game), engine.past_guesses(game))
+		if hint.word:
+			return hint.word, True
+		return (hint.letter, False) if hint.letter else None
+	return guess
+
+
+STRATEGIES = {"random": random_letters, "frequency": frequency, "candidates": candidates, "solver": solver}
+
+
+def load_strategy(name):
+	"""Returns a built in strategy, or one named as module:function"""
+	if name in STRATEGIES:
+		return STRATEGIES[name]
+	module, _, function = name.partition(":")
+	return getattr(importlib.import_module(module), function)
+
+
+def play(game, guesser):
+	"""Plays one game to the end.
+	Returns:
+		The finishing Outcome, or None if the guesser gave up, and the
+		number of guesses made."""
+	guesses = 0
+	while True:
+		choice = guesser(game)
+		if choice is None:
+			return None, guesses
+		guess, is_word = choice
+		outcome = engine.guess_word(game, guess) if is_word else engine.guess_letter(game, guess)
+		guesses += 1
+		if not outcome.moved:
+			return None, guesses
+		if outcome.finished:
+			return outcome, guesses
+
+
+_worker = {}
+
+
+def _start_worker(source, strategy):
+	words = list(WordStore(source))
+	rng = random.Random()
+	_worker.update(words=words, rng=rng, guesser=load_strategy(strategy)(words, rng))
+
+
+def play_chunk(task):
+	"""Plays one chunk of games in a worker process. Each chunk seeds the
+	random numbers from its own number, so results do not depend on which
+	process plays it.
+	Returns:
+		The number of games won, the number of guesses made and a Counter of
+		scores in tenths of a point."""
+	seed, number, size = task
+	words, rng, guesser = _worker["words"], _worker["rng"], _worker["guesser"]
+	rng.seed(seed * 1000003 + number)
+	wins, guesses, scores = 0, 0, Counter()
+	for _ in range(size):
+		outcome, made = play(engine.State(rng.choice(words)), guesser)
+		guesses += made
+		if outcome and outcome.won:
+			wins += 1
+			scores[int(round(outcome.score * 10))] += 1
+		else:
+			scores[0] += 1
+	return wins, guesses, scores
+
+
+def simulate(games, strategy, processes, seed, source=NAMES):
+	"""Plays games across a pool of processes.
+	Returns:
+		The number of games won, the number of guesses made, a Counter of
+		scores in tenths of a point and the wall time in seconds."""
+	tasks = [(seed, number, min(CHUNK_SIZE, games - start))
+			 for number, start in enumerate(range(0, games, CHUNK_SIZE))]
+	pool = multiprocessing.Pool(processes, _start_worker, (source, strategy))
+	start = time.time()
+	wins, guesses, scores = 0, 0, Counter()
+	try:
+		for chunk_wins, chunk_guesses, chunk_scores in pool.imap_unordered(play_chunk, tasks):
+			wins += chunk_wins
+			guesses += chunk_guesses
+			scores.update(chunk_scores)
+	finally:
+		pool.terminate()
+	return wins, guesses, scores, time.time() - start
+
+
+def percentile(scores, fraction):
+	"""Returns the nearest-rank percentile, in points, of a Counter of scores
+	in tenths"""
+	rank = fraction * sum(scores.values())
+	seen = 0
+	for tenths in sorted(scores):
+		seen += scores[tenths]
+		if seen >= rank:
+			return tenths / 10
+	return 0.0
+
+
+def report(games, wins, guesses, scores, elapsed):
+	print("games           {}".format(games))
+	print("games per sec   {:.0f}".format(games / elapsed if elapsed else 0))
+	print("wins            {} ({:.1%})".format(wins, wins / games))
+	print("mean guesses    {:.2f}".format(guesses / games))
+	print("mean score      {:.2f}".format(sum(tenths * count for tenths, count in scores.items()) / 10 / games))
+	print("median score    {:.1f}".format(percentile(scores, 0.5)))
+	print("p90 score       {:.1f}".format(percentile(scores, 0.9)))
+	print("scores")
+	bins = Counter()
+	for tenths, count in scores.items():
+		bins[tenths // 10] += count
+	for points in range(0, 11):
+		share = bins[points] / games
+		label = "{:>2}".format(points) if points == 10 else "{}-{}".format(points, points + 1)
+		print("  {:>5}  {:>7.2%}  {}".format(label, share, "#" * int(round(share * 50))))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--games", type=int, default=100000)
+	parser.add_argument("--strategy", default="candidates",
+						help="one of {} or module:function".format(", ".join(sorted(STRATEGIES))))
+	parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--names", default=NAMES, help="the word list to draw names from")
+	args = parser.parse_args()
+	if args.games < 1:
+		parser.error("--games must be at least 1")
+	load_strategy(args.strategy)
+
+	wins, guesses, scores, elapsed = simulate(args.games, args.strategy, args.processes, args.seed, args.names)
+	print("strategy        {}".format(args.strategy))
+	print("processes       {}".format(args.processes))
+	report(args.games, wins, guesses, scores, elapsed)
+
+
+if __name__ == "__main__":
+	main()
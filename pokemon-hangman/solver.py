@@ -0,0 +1,177 @@
+"""solver.py - Suggests the most informative next guess in a game.
+
+The word list is indexed once into buckets of words of the same length. For
+each symbol in a bucket a NumPy array holds, per word, a bitmask of the
+positions the symbol appears at. Finding the words consistent with a game and
+ranking the unguessed symbols by the entropy of the positions they would
+reveal are then a few vectorised operations over those arrays.
+
+Run it directly to have the solver play a game against every word:
+	python solver.py [names.txt]
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy
+
+import engine
+
+# letter is the symbol to guess next, or None when word is set because only
+# one word fits. candidates is the number of words that fit the game and
+# entropy the expected information, in bits, of guessing letter
+Hint = namedtuple("Hint", ["letter", "word", "candidates", "entropy"])
+
+
+class Bucket(object):
+	"""The lowercased words of one length and, for every symbol they use, a
+	row of per-word position bitsets"""
+
+	def __init__(self, words):
+		self.words = words
+		self.columns = dict((word, column) for column, word in enumerate(words))
+		self.symbols = sorted(set(symbol for word in words for symbol in word))
+		self.rows = dict((symbol, row) for row, symbol in enumerate(self.symbols))
+		self.masks = numpy.zeros((len(self.symbols), len(words)), dtype=numpy.uint64)
+		for column, word in enumerate(words):
+			for symbol, mask in engine.letter_masks(word).items():
+				self.masks[self.rows[symbol], column] = mask
+
+	def candidates(self, revealed, wrong_words):
+		"""Returns a boolean array marking the words whose position bitset
+		for every symbol in revealed equals the bitset given for it, and which
+		are not among wrong_words"""
+		keep = numpy.ones(len(self.words), dtype=bool)
+		for symbol, mask in revealed.items():
+			row = self.rows.get(symbol)
+			if row is not None:
+				keep &= self.masks[row] == numpy.uint64(mask)
+			elif mask:
+				keep[:] = False
+		for word in wrong_words:
+			column = self.columns.get(word)
+			if column is not None:
+				keep[column] = False
+		return keep
+
+	def rank(self, keep, exclude):
+		"""Scores every symbol not in exclude against the words marked in
+		keep. The words are unicode, like the game's, so a symbol outside
+		ASCII is one character and can be guessed like any other. Sorting each symbol's bitsets groups the words by the positions
+		a guess would reveal, and the sizes of those groups give its entropy.
+		Returns:
+			A list of (entropy, share of the words containing it, symbol)"""
+		symbols = [symbol for symbol in self.symbols if symbol not in exclude]
+		columns = numpy.flatnonzero(keep)
+		if not symbols or not len(columns):
+			return []
+		rows = [self.rows[symbol] for symbol in symbols]
+		masks = numpy.sort(self.masks[rows][:, columns], axis=1)
+		count = masks.shape[1]
+		starts = numpy.ones(masks.shape, dtype=bool)
+		starts[:, 1:] = masks[:, 1:] != masks[:, :-1]
+		# Every row starts a new group, so groups never span two rows
+		group_starts = numpy.flatnonzero(starts.ravel())
+		shares = numpy.diff(numpy.append(group_starts, masks.size)) / count
+		entropy = numpy.add.reduceat(-shares * numpy.log2(shares),
+									 numpy.flatnonzero(group_starts % count == 0))
+		present = (masks != 0).sum(axis=1) / count
+		return list(zip(entropy.tolist(), present.tolist(), symbols))
+
+
+class CandidateIndex(object):
+	"""Candidate filtering and next guess ranking over a word list"""
+
+	def __init__(self, words):
+		"""Words are bucketed by their length in characters, so UTF-8 encoded
+		words, as a WordStore returns them under Python 2, are decoded first
+		to match the unicode words of a game"""
+		by_length = {}
+		for word in words:
+			if isinstance(word, bytes):
+				word = word.decode("utf-8")
+			by_length.setdefault(len(word), set()).add(word.lower())
+		self.buckets = dict((length, Bucket(sorted(bucket)))
+							for length, bucket in by_length.items())
+
+	def hint(self, word_so_far, past_guesses):
+		"""Suggests the next guess for a game.
+		Args:
+			word_so_far: The word with every unrevealed position blank
+			past_guesses: The lowercased letters and words guessed so far
+		Returns:
+			A Hint. Both letter and word are None if no word fits the game,
+			or if several fit but no symbol that can be guessed is left to
+			tell them apart. candidates tells the two cases apart."""
+		bucket = self.buckets.get(len(word_so_far))
+		if bucket is None:
+			return Hint(None, None, 0, 0.0)
+		revealed = dict((guess, 0) for guess in past_guesses if len(guess) == 1)
+		for symbol, mask in engine.letter_masks(word_so_far.lower()).items():
+			if symbol != engine.BLANK:
+				revealed[symbol] = mask
+		wrong_words = [guess for guess in past_guesses if len(guess) > 1]
+		keep = bucket.candidates(revealed, wrong_words)
+		count = int(keep.sum())
+		if count == 1:
+			return Hint(None, bucket.words[numpy.flatnonzero(keep)[0]], 1, 0.0)
+		ranking = bucket.rank(keep, revealed)
+		if not ranking:
+			return Hint(None, None, count, 0.0)
+		# Most informative first, then the letter most likely to be in the word
+		entropy, present, letter = max(ranking, key=lambda item: item[:2])
+		return Hint(letter, None, count, entropy)
+
+
+def play(index, word):
+	"""Plays one game against word with the engine, always taking the hint.
+	Returns:
+		The score (0.0 for a loss) and the number of guesses made."""
+	game = engine.State(word)
+	guesses = 0
+	while True:
+		hint = index.hint(engine.word_so_far(game), engine.past_guesses(game))
+		if hint.word is None and hint.letter is None:
+			return 0.0, guesses
+		if hint.word:
+			outcome = engine.guess_word(game, hint.word)
+		else:
+			outcome = engine.guess_letter(game, hint.letter)
+		guesses += 1
+		if outcome.finished:
+			return outcome.score, guesses
+
+
+def main():
+	"""Plays every word in a word list and reports the win rate, scores and
+	time per hint"""
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	from wordstore import WordStore
+	source = sys.argv[1] if len(sys.argv) > 1 else \
+		os.path.join(os.path.dirname(os.path.abspath(__file__)), "names.txt")
+	words = list(WordStore(source))
+	start = time.time()
+	index = CandidateIndex(words)
+	built = time.time() - start
+	start = time.time()
+	results = [play(index, word) for word in words]
+	elapsed = time.time() - start
+	scores = [score for score, guesses in results]
+	guesses = sum(guesses for score, guesses in results)
+	wins = sum(1 for score in scores if score)
+	print("words           {}".format(len(words)))
+	print("index built in  {:.1f} ms".format(built * 1000))
+	print("wins            {} ({:.1%})".format(wins, wins / len(words)))
+	print("mean score      {:.2f}".format(sum(scores) / len(words)))
+	print("mean guesses    {:.2f}".format(guesses / len(words)))
+	print("time per hint   {:.3f} ms".format(elapsed * 1000 / guesses))
+	for word, (score, _) in zip(words, results):
+		if not score:
+			print("lost            {}".format(word))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,143 @@
+"""stats.py - Per-endpoint latency and API RPC instrumentation.
+
+Wrap endpoint methods and handler methods with @instrumented. While one is
+running, apiproxy hooks count and time the datastore, memcache and taskqueue
+calls it makes, and count() records events such as transaction retries.
+Each instance buffers latency histograms and RPC and event counts, and adds
+them to memcache at most every FLUSH_INTERVAL seconds so get_stats()
+reports totals from all instances."""
+
+import functools
+import threading
+import time
+from collections import defaultdict
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+NAMESPACE = "endpoint_stats"
+FLUSH_INTERVAL = 10
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+CATEGORIES = {
+	("datastore_v3", "Get"): "datastore_get",
+	("datastore_v3", "Put"): "datastore_put",
+	("datastore_v3", "Delete"): "datastore_delete",
+	("datastore_v3", "RunQuery"): "datastore_query",
+	("datastore_v3", "Next"): "datastore_query",
+	("datastore_v3", "BeginTransaction"): "datastore_transaction",
+	("datastore_v3", "Commit"): "datastore_commit",
+	("datastore_v3", "Rollback"): "datastore_rollback",
+}
+SERVICES = {"memcache": "memcache", "taskqueue": "taskqueue", "datastore_v3": "datastore_other"}
+# Counted by the instrumented code itself, with count()
+EVENTS = ["transaction_retries", "transaction_conflicts", "duplicate_moves", "dropped_moves"]
+
+_names = []
+_local = threading.local()
+_lock = threading.Lock()
+_pending = defaultdict(int)
+_last_flush = [time.time()]
+
+
+def _category(service, call):
+	return CATEGORIES.get((service, call)) or SERVICES.get(service, "other")
+
+
+def _pre_call(service, call, request, response):
+	record = getattr(_local, "record", None)
+	if record is not None:
+		record[_category(service, call)] += 1
+		record["started:{}".format(id(response))] = time.time()
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+	record = getattr(_local, "record", None)
+	if record is not None:
+		started = record.pop("started:{}".format(id(response)), None)
+		if started is not None:
+			record[_category(service, call) + "_ms"] += int((time.time() - started) * 1000)
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("stats", _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("stats", _post_call)
+
+
+def _bucket(elapsed_ms):
+	for bound in BUCKETS:
+		if elapsed_ms <= bound:
+			return "le_{}".format(bound)
+	return "gt_{}".format(BUCKETS[-1])
+
+
+def _record(name, record, elapsed_ms, error):
+	"""Adds one call to the buffered totals and flushes them to memcache
+	when FLUSH_INTERVAL has passed"""
+	with _lock:
+		_pending[name + ":calls"] += 1
+		_pending[name + ":latency_ms"] += elapsed_ms
+		_pending[name + ":latency:" + _bucket(elapsed_ms)] += 1
+		if error:
+			_pending[name + ":errors"] += 1
+		for metric, value in record.items():
+			if not metric.startswith("started:"):
+				_pending[name + ":" + metric] += value
+		if time.time() - _last_flush[0] < FLUSH_INTERVAL:
+			return
+		counts = dict(_pending)
+		_pending.clear()
+		_last_flush[0] = time.time()
+	memcache.offset_multi(counts, namespace=NAMESPACE, initial_value=0)
+
+
+def instrumented(name_or_func):
+	"""Decorator that records the latency and API RPCs of each call under a
+	name. Use it bare to take the name from the function, or pass the name
+	as @instrumented("name")"""
+	def decorator(func, name):
+		_names.append(name)
+
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			outer = getattr(_local, "record", None)
+			_local.record = defaultdict(int)
+			start = time.time()
+			error = True
+			try:
+				result = func(*args, **kwargs)
+				error = False
+				return result
+			finally:
+				record, _local.record = _local.record, outer
+				_record(name, record, int((time.time() - start) * 1000), error)
+		return wrapper
+
+	if callable(name_or_func):
+		return decorator(name_or_func, name_or_func.__name__)
+	return lambda func: decorator(func, name_or_func)
+
+
+def count(event, value=1):
+	"""Counts an event, such as a transaction retry, against the instrumented
+	call that is running. Events outside of one are not counted"""
+	record = getattr(_local, "record", None)
+	if record is not None:
+		record[event] += value
+
+
+def get_stats():
+	"""Returns the totals flushed by every instance, as a dict of instrumented
+	name to metric to value, with the mean latency of each name added"""
+	metrics = ["calls", "errors", "latency_ms"] + ["latency:" + _bucket(bound) for bound in BUCKETS]
+	metrics += ["latency:gt_{}".format(BUCKETS[-1])]
+	metrics += EVENTS
+	for category in sorted(set(CATEGORIES.values()) | set(SERVICES.values()) | set(["other"])):
+		metrics += [category, category + "_ms"]
+	keys = ["{}:{}".format(name, metric) for name in _names for metric in metrics]
+	values = memcache.get_multi(keys, namespace=NAMESPACE)
+	stats = {}
+	for name in _names:
+		entry = dict((metric, values.get("{}:{}".format(name, metric), 0)) for metric in metrics)
+		if entry["calls"]:
+			entry["mean_latency_ms"] = round(entry["latency_ms"] / float(entry["calls"]), 1)
+		stats[name] = entry
+	return stats
@@ -0,0 +1,142 @@
+"""test_moves.py - Counts the datastore RPCs each move makes.
+
+Runs the endpoints against the App Engine testbed stubs and checks that a
+move is one transaction with one batch get and one batch put, however it
+reaches _commit_moves, followed by at most one counter shard update. Needs the App Engine SDK:
+	APPENGINE_SDK=~/google_appengine python -m unittest test_moves
+"""
+
+import json
+import os
+import unittest
+
+import benchmark
+
+# A move reads the Game and the user's Ranking with one get and writes them
+# with one put, in one transaction
+MOVE = {"BeginTransaction": 1, "Get": 1, "Put": 1, "Commit": 1}
+# Ending the game also reads the user's period score buckets and queues the
+# leaderboard update in the transaction
+FINISHING_MOVE = {"BeginTransaction": 1, "Get": 2, "Put": 1, "Commit": 1, "AddActions": 1}
+# A retried move_id is answered from the Game without writing
+RETRIED_MOVE = {"BeginTransaction": 1, "Get": 1, "Commit": 1}
+# A move that changes the active game counters adds to a shard in its own
+# transaction once it has committed
+COUNTER_UPDATE = {"BeginTransaction": 1, "Get": 1, "Put": 1, "Commit": 1}
+
+
+def plus(*budgets):
+	"""Returns the sum of RPC budgets"""
+	total = {}
+	for budget in budgets:
+		for rpc, count in budget.items():
+			total[rpc] = total.get(rpc, 0) + count
+	return total
+
+
+def setUpModule():
+	sdk = os.environ.get("APPENGINE_SDK")
+	if not sdk:
+		raise unittest.SkipTest("Set APPENGINE_SDK to the path of the App Engine SDK")
+	benchmark.setup_sdk(sdk)
+
+
+class MoveRPCTest(unittest.TestCase):
+
+	def setUp(self):
+		from google.appengine.ext import testbed
+		import cache
+		self.bed = benchmark.start_testbed()
+		# Users cached in process by an earlier test are gone from its stubs
+		cache._entities.entries.clear()
+		self.queue = self.bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+		self.recorder = benchmark.Recorder()
+		self.recorder.install()
+		from google.appengine.ext import ndb
+		import game
+		import models
+		self.ndb, self.game, self.models = ndb, game, models
+		self.api = game.PokemonHangmanAPI()
+		self.api.create_user(game.USER_REQUEST.combined_message_class(user_name="ash", email="ash@example.com"))
+		self.form = self.api.new_game(game.NEW_GAME_REQUEST.combined_message_class(user_name="ash"))
+		self.word = ndb.Key(urlsafe=self.form.urlsafe_key).get().word
+
+	def tearDown(self):
+		self.bed.deactivate()
+
+	def call(self, method, request):
+		"""Calls an endpoint or handler as a fresh request would, with an
+		empty ndb context cache.
+		Returns:
+			The response and the datastore RPCs made, by call name"""
+		self.ndb.get_context().clear_cache()
+		response = self.recorder.call("move", method, request)
+		return response, dict((rpc.split(".", 1)[1], count) for rpc, count in self.recorder.last_counts().items()
+							  if rpc.startswith("datastore_v3."))
+
+	def guess(self, guess, **fields):
+		return self.call(self.api.guess_letter, self.game.GUESS_REQUEST.combined_message_class(
+			urlsafe_game_key=self.form.urlsafe_key, guess=guess, **fields))
+
+	def missing_letter(self):
+		return next(ltr for ltr in "qxzjvkwyfbg" if ltr not in self.word.lower())
+
+	def test_letter(self):
+		form, rpcs = self.guess(self.missing_letter())
+		self.assertFalse(form.game_over)
+		self.assertEqual(rpcs, plus(MOVE, COUNTER_UPDATE))
+
+	def test_word(self):
+		form, rpcs = self.call(self.api.guess_word, self.game.GUESS_REQUEST.combined_message_class(
+			urlsafe_game_key=self.form.urlsafe_key, guess=self.word))
+		self.assertTrue(form.game_over)
+		self.assertEqual(rpcs, plus(FINISHING_MOVE, COUNTER_UPDATE))
+
+	def test_batch(self):
+		guesses = [self.models.BatchGuessForm(guess=ltr) for ltr in "aeiou"]
+		result, rpcs = self.call(self.api.guess_batch, self.game.GUESS_BATCH_REQUEST.combined_message_class(
+			urlsafe_game_key=self.form.urlsafe_key, guesses=guesses))
+		budget = FINISHING_MOVE if result.game.game_over else MOVE
+		if result.game.game_over or result.game.attempts_remaining != self.form.attempts_remaining:
+			budget = plus(budget, COUNTER_UPDATE)
+		self.assertEqual(rpcs, budget)
+
+	def test_retried_move(self):
+		letter = self.missing_letter()
+		self.guess(letter, move_id="move-1")
+		form, rpcs = self.guess(letter, move_id="move-1")
+		self.assertEqual(form.attempts_remaining, 5)
+		self.assertEqual(rpcs, RETRIED_MOVE)
+
+	def test_token_move(self):
+		form, rpcs = self.guess(self.missing_letter(), state_token=self.form.state_token)
+		self.assertFalse(form.game_over)
+		self.assertEqual(rpcs, {})
+		tasks = self.queue.get_filtered_tasks(queue_names=["moves"])
+		self.assertEqual(len(tasks), 1)
+
+		_, rpcs = self.call(self.commit, tasks[0].extract_params())
+		self.assertEqual(rpcs, plus(MOVE, COUNTER_UPDATE))
+
+	def test_token_moves_after_lost_claim(self):
+		from google.appengine.api import memcache
+		letters = [ltr for ltr in "qxzjvkwyfbg" if ltr not in self.word.lower()]
+		form, _ = self.guess(letters[0], state_token=self.form.state_token)
+		# memcache evicts the claim, so a direct move takes the same version
+		memcache.flush_all()
+		self.guess(letters[1])
+		form, _ = self.guess(letters[2], state_token=form.state_token)
+		for task in self.queue.get_filtered_tasks(queue_names=["moves"]):
+			_, rpcs = self.call(self.commit, task.extract_params())
+			self.assertNotIn("Put", rpcs)
+		game = self.ndb.Key(urlsafe=self.form.urlsafe_key).get()
+		self.assertEqual(game.past_guesses, [letters[1]])
+
+	def commit(self, params):
+		"""Runs a queued commit_moves task"""
+		self.api.commit_queued_moves(self.ndb.Key(urlsafe=params["game_key"]), int(params["version"]),
+									 json.loads(params["moves"]), params.get("move_id"), params.get("state"))
+
+
+if __name__ == "__main__":
+	unittest.main()
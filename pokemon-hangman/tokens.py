@@ -0,0 +1,133 @@
+"""tokens.py - Signed, encrypted game state tokens and move version claims.
+
+A token carries the whole state of an active game, so a guess that presents
+one can be evaluated without reading the Game. The JSON state is encrypted
+with an HMAC-SHA256 keystream, so the word stays hidden, and signed together
+with the game's key, so a token only works for its own game. Both keys are
+derived from a random secret kept in the datastore.
+
+Every committed move increments the Game's version. Before a move is made
+from version N, the move claims N with memcache.add, so each version can be
+moved from only once. A replayed or stale token loses that claim and the move
+falls back to the datastore, as does any token move while memcache is down.
+Claims are best effort. A version number alone does not say which moves led
+to it, so each queued move also carries the digest of the state it was made
+from, and it is only saved if the Game's state still has that digest."""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import struct
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+TOKEN_FORMAT = b"\x01"
+NONCE_SIZE = 8
+MAC_SIZE = 16
+CLAIM_TIMEOUT = 24 * 60 * 60
+CLAIM_NAMESPACE = "game_versions"
+
+_keys = []
+
+
+class TokenSecret(ndb.Model):
+	"""The random secret the token keys are derived from"""
+	value = ndb.BlobProperty(required=True)
+
+
+class OutOfOrder(Exception):
+	"""A queued move reached a Game before the moves queued ahead of it"""
+
+
+def _get_keys():
+	"""Returns the encryption and signing keys, read once per instance"""
+	if not _keys:
+		secret = TokenSecret.get_or_insert("state_token", value=os.urandom(32)).value
+		_keys[:] = [hmac.new(secret, purpose, hashlib.sha256).digest() for purpose in (b"encrypt", b"sign")]
+	return _keys
+
+
+def _keystream(key, nonce, size):
+	blocks = []
+	for counter in range(0, size, hashlib.sha256().digest_size):
+		blocks.append(hmac.new(key, nonce + struct.pack(">I", counter), hashlib.sha256).digest())
+	return b"".join(blocks)[:size]
+
+
+def _xor(data, stream):
+	return bytes(bytearray(a ^ b for a, b in zip(bytearray(data), bytearray(stream))))
+
+
+def _equal(a, b):
+	"""Compares two MACs in constant time"""
+	if len(a) != len(b):
+		return False
+	result = 0
+	for x, y in zip(bytearray(a), bytearray(b)):
+		result |= x ^ y
+	return result == 0
+
+
+def encode(game_key, state):
+	"""Returns the urlsafe token for a game's state, a JSON serializable dict"""
+	encrypt_key, sign_key = _get_keys()
+	payload = json.dumps(state, separators=(",", ":")).encode("utf-8")
+	nonce = os.urandom(NONCE_SIZE)
+	body = nonce + _xor(payload, _keystream(encrypt_key, nonce, len(payload)))
+	mac = hmac.new(sign_key, game_key.urlsafe() + body, hashlib.sha256).digest()[:MAC_SIZE]
+	return base64.urlsafe_b64encode(TOKEN_FORMAT + body + mac).rstrip(b"=").decode("ascii")
+
+
+def decode(game_key, token):
+	"""Returns the state a token carries, or None if the token is malformed,
+	was not issued by this app or was issued for another game"""
+	try:
+		data = base64.urlsafe_b64decode(str(token) + "=" * (-len(token) % 4))
+	except (TypeError, ValueError, UnicodeError):
+		return None
+	if len(data) <= 1 + NONCE_SIZE + MAC_SIZE or data[:1] != TOKEN_FORMAT:
+		return None
+	encrypt_key, sign_key = _get_keys()
+	body, mac = data[1:-MAC_SIZE], data[-MAC_SIZE:]
+	if not _equal(mac, hmac.new(sign_key, game_key.urlsafe() + body, hashlib.sha256).digest()[:MAC_SIZE]):
+		return None
+	nonce, ciphertext = body[:NONCE_SIZE], body[NONCE_SIZE:]
+	try:
+		return json.loads(_xor(ciphertext, _keystream(encrypt_key, nonce, len(ciphertext))).decode("utf-8"))
+	except ValueError:
+		return None
+
+
+def digest(state):
+	"""Returns a short hex digest of a game's state, a JSON serializable dict,
+	that tells apart states reached by different moves"""
+	return hashlib.sha256(json.dumps(state, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()[:32]
+
+
+def _claim_key(game_key, version):
+	return "{}:{}".format(game_key.urlsafe(), version)
+
+
+def claim(game_key, version, owner):
+	"""Claims the move from a version of a game for owner, a string unique to
+	the request. Claiming again with the same owner succeeds, so a retried
+	transaction keeps its claim.
+	Returns:
+		True if owner holds the claim, False if another request holds it, or
+		None if memcache could not say, as when it is unavailable."""
+	key = _claim_key(game_key, version)
+	if memcache.add(key, owner, time=CLAIM_TIMEOUT, namespace=CLAIM_NAMESPACE):
+		return True
+	holder = memcache.get(key, namespace=CLAIM_NAMESPACE)
+	if holder is None:
+		return None
+	return holder == owner
+
+
+def release(game_key, version, owner):
+	"""Gives up a claim when the move it was taken for is not made"""
+	key = _claim_key(game_key, version)
+	if memcache.get(key, namespace=CLAIM_NAMESPACE) == owner:
+		memcache.delete(key, namespace=CLAIM_NAMESPACE)
@@ -1,56 +1,73 @@
-"""utils.py - Contains utility functions for getting a Pokemon name as well as getting a ndb Model from its urlsafe key"""
+"""utils.py - Contains utility functions for getting a Pokemon name as well as getting an ndb Key from its urlsafe string"""
 
 import endpoints
 import os
-from random import randrange
+import time
+import stats
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from engine import word_index
+from wordstore import WordStore
 
 PATH = os.path.join(os.path.dirname(__file__), "names.txt")
+MASK_CACHE_SIZE = 4096
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+TRANSACTION_RETRIES = 3
+RETRY_DELAY = 0.05
 
 class PokemonNames():
-    """Get all Pokemon names and puts them in a list"""
+    """Get Pokemon names from a compact word store, which is only read on
+    first use and never loads every name into memory"""
 
-    def __init__(self, default=True):
-        """Initialize the list of Pokemon names"""
-        self.namesDict = {}
-        self.totalPokemon = 0
-        if default:
-            self.namesDict = self.get_from_file(PATH)
-
-    def get_from_file(self, filePath):
-        """Read the txt file containing all Pokemon names"""
-        file = open(filePath, 'r')
-        lines = file.readlines()
-        self.totalCount = len(lines)
-        for index, val in enumerate(lines):
-            lines[index] = val.split()
-        namesDict = {}
-        for line in lines:
-            namesDict[int(line[0])] = line[1]
-        return namesDict
+    def __init__(self, default=True, store=None):
+        """Initialize the store of Pokemon names"""
+        self.store = store
+        self.maskCache = {}
+        self.candidateIndex = None
+        if default and store is None:
+            self.store = WordStore(PATH)
 
     def get_random_name(self):
         """Return a random name"""
-        key = randrange(1, self.totalCount + 1)
-        return self.namesDict[key]
+        return self.store.random()
 
     def get_name(self, key):
         """Get a name by a Pokemon's Pokedex number"""
-        return self.namesDict.get(key, None)
+        if not 1 <= key <= len(self.store):
+            return None
+        return self.store.get(key - 1)
+
+    def get_word_index(self, name):
+        """Get the lowercased form and letter position masks of a name,
+        computed once per name and cached up to MASK_CACHE_SIZE names"""
+        index = self.maskCache.get(name)
+        if index is None:
+            if len(self.maskCache) >= MASK_CACHE_SIZE:
+                self.maskCache.clear()
+            index = self.maskCache[name] = word_index(name)
+        return index
+
+    def get_candidate_index(self):
+        """Get the solver's candidate index over every name. It is built on
+        first use, so NumPy is only loaded by instances that serve hints"""
+        if self.candidateIndex is None:
+            from solver import CandidateIndex
+            self.candidateIndex = CandidateIndex(self.store)
+        return self.candidateIndex
 
-def get_by_urlsafe(urlsafe, model):
-	"""Returns an ndb.Model entity that the urlsafe key points to. Checks
-		that the type of entity returned is of the correct kind. Raises an
-		error if the key String is malformed or the entity is of the incorrect
-		kind
+def get_key_by_urlsafe(urlsafe, model):
+	"""Returns the ndb.Key that a urlsafe key string encodes, without
+		fetching the entity. Raises an error if the key String is malformed or
+		is for an entity of the incorrect kind
 	Args:
 		urlsafe: A urlsafe key string
 		model: The expected entity kind
 	Returns:
-		The entity that the urlsafe Key string points to or None if no entity
-		exists.
+		The ndb.Key the urlsafe Key string encodes.
 	Raises:
-		ValueError:"""
+		endpoints.BadRequestException:"""
 	try:
 		key = ndb.Key(urlsafe=urlsafe)
 	except TypeError:
@@ -60,10 +77,83 @@ def get_by_urlsafe(urlsafe, model):
 			raise endpoints.BadRequestException('Invalid Key')
 		else:
 			raise
+	if key.kind() != model._get_kind():
+		raise endpoints.BadRequestException('Incorrect Kind')
+	return key
 
-	entity = key.get()
-	if not entity:
+def get_cursor(urlsafe):
+	"""Returns a query Cursor from its urlsafe string, or None for an empty
+	or missing string so that the query starts from the beginning.
+	Raises:
+		endpoints.BadRequestException: if the string is not a valid cursor"""
+	if not urlsafe:
 		return None
-	if not isinstance(entity, model):
-		raise endpoints.BadRequestException('Incorrect Kind')
-	return entity
+	try:
+		return Cursor(urlsafe=urlsafe)
+	except Exception:
+		raise endpoints.BadRequestException('Invalid Cursor')
+
+def get_page_size(page_size):
+	"""Returns the number of results to page by, DEFAULT_PAGE_SIZE when none
+	was requested and at most MAX_PAGE_SIZE.
+	Raises:
+		endpoints.BadRequestException: if page_size is below 1"""
+	if page_size is None:
+		return DEFAULT_PAGE_SIZE
+	if page_size < 1:
+		raise endpoints.BadRequestException('page_size must be at least 1')
+	return min(page_size, MAX_PAGE_SIZE)
+
+def fetch_page(query, page_size, cursor):
+	"""Fetches one page of results from a query.
+	Args:
+		query: The ndb query to page through
+		page_size: The requested number of results, capped at MAX_PAGE_SIZE
+		cursor: The urlsafe cursor returned with the previous page, if any
+	Returns:
+		A tuple of the results, the urlsafe cursor for the next page (None on
+		the last page) and whether there are more results."""
+	return fetch_page_async(query, page_size, cursor).get_result()
+
+@ndb.tasklet
+def fetch_page_async(query, page_size, cursor):
+	"""Tasklet version of fetch_page"""
+	start_cursor = get_cursor(cursor)
+	page_size = get_page_size(page_size)
+	results, next_cursor, more = yield query.fetch_page_async(page_size, start_cursor=start_cursor)
+	if not (more and next_cursor):
+		raise ndb.Return(results, None, False)
+	raise ndb.Return(results, next_cursor.urlsafe(), True)
+
+def page_list(items, page_size, cursor):
+	"""Returns one page of an in-memory list, using the same paging contract
+	as fetch_page. The cursor is the string offset of the page.
+	Returns:
+		A tuple of the items, the cursor for the next page (None on the last
+		page) and whether there are more items."""
+	try:
+		start = int(cursor or 0)
+	except ValueError:
+		raise endpoints.BadRequestException('Invalid Cursor')
+	if start < 0:
+		raise endpoints.BadRequestException('Invalid Cursor')
+	end = start + get_page_size(page_size)
+	if end >= len(items):
+		return items[start:], None, False
+	return items[start:end], str(end), True
+
+def run_in_transaction(func, retries=TRANSACTION_RETRIES, **options):
+	"""Runs func in an ndb transaction, retrying up to retries times with
+	exponential backoff when it collides with another transaction on the same
+	entity group. Each retry and each final collision is counted in stats.
+	Raises:
+		datastore_errors.TransactionFailedError: if every attempt collided"""
+	for attempt in range(retries + 1):
+		try:
+			return ndb.transaction(func, retries=0, **options)
+		except datastore_errors.TransactionFailedError:
+			if attempt == retries:
+				stats.count("transaction_conflicts")
+				raise
+			stats.count("transaction_retries")
+			time.sleep(RETRY_DELAY * 2 ** attempt)
@@ -0,0 +1,186 @@
+"""wordstore.py - A compact, lazily loaded store for large word lists.
+
+The text word list ("<number> <word>" per line) is compiled once into a binary
+file made of a small header, an array of little-endian uint32 offsets and a
+packed UTF-8 blob of every word. The binary file is memory-mapped on first
+use, so looking up a word is O(1) and never materialises the rest of the list.
+
+The binary file is built ahead of time and deployed with the app, since App
+Engine cannot write files. Its header records the SHA-1 of the text it was
+built from, which is only checked when building, never when serving:
+	python wordstore.py names.txt names.bin           (rebuild if stale)
+	python wordstore.py --check names.txt names.bin   (exit 1 if stale)
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import sys
+from random import randrange
+
+try:
+	import mmap
+except ImportError:
+	mmap = None
+
+MAGIC = b"PKWS"
+VERSION = 2
+# magic, version, word count, SHA-1 of the source
+HEADER = struct.Struct("<4sII20s")
+OFFSET = struct.Struct("<I")
+
+
+def read_source(source):
+	"""Yield the words of a text word list in order. Each line holds a
+	Pokedex number and a word, and numbers must run from 1 without gaps"""
+	with open(source, "rb") as f:
+		for index, line in enumerate(f):
+			fields = line.split()
+			if not fields:
+				continue
+			if int(fields[0]) != index + 1:
+				raise ValueError("{}: line {} is numbered {}".format(source, index + 1, fields[0]))
+			yield fields[1]
+
+
+def source_digest(source):
+	"""Return the SHA-1 digest of a text word list's contents"""
+	digest = hashlib.sha1()
+	with open(source, "rb") as f:
+		for block in iter(lambda: f.read(65536), b""):
+			digest.update(block)
+	return digest.digest()
+
+
+def read_header(path):
+	"""Return the word count and source digest of a binary store file, or
+	None if it is missing or not a store of this version"""
+	try:
+		with open(path, "rb") as f:
+			header = f.read(HEADER.size)
+	except IOError:
+		return None
+	if len(header) < HEADER.size:
+		return None
+	magic, version, count, digest = HEADER.unpack(header)
+	if magic != MAGIC or version != VERSION:
+		return None
+	return count, digest
+
+
+def is_current(source, target):
+	"""Check that a binary store file was built from the source's current
+	contents. This reads the whole source, so it is for build time only"""
+	header = read_header(target)
+	return header is not None and header[1] == source_digest(source)
+
+
+def pack(words, digest=b"\0" * 20):
+	"""Return the binary store for an iterable of UTF-8 encoded words"""
+	offsets = [0]
+	blob = []
+	for word in words:
+		blob.append(word)
+		offsets.append(offsets[-1] + len(word))
+	header = HEADER.pack(MAGIC, VERSION, len(offsets) - 1, digest)
+	return header + struct.pack("<{}I".format(len(offsets)), *offsets) + b"".join(blob)
+
+
+def build(source, target):
+	"""Compile a text word list into a binary store file"""
+	data = pack(read_source(source), source_digest(source))
+	tmp = target + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(data)
+	os.rename(tmp, target)
+
+
+class WordStore(object):
+	"""Read-only, random access view of a compiled word list"""
+
+	def __init__(self, source, path=None):
+		"""Nothing is read until the first lookup. A binary file with a valid
+		header is trusted as is. If it is missing it is built when the file
+		system allows it, and the list is packed in memory otherwise"""
+		self.source = source
+		self.path = path or os.path.splitext(source)[0] + ".bin"
+		self._buf = None
+		self._count = 0
+
+	def _open(self):
+		"""Map the binary file, building it first if needed"""
+		if read_header(self.path) is None:
+			try:
+				build(self.source, self.path)
+			except (IOError, OSError):
+				logging.warning("%s is missing, so %s is packed in memory. Deploy it with the app",
+								self.path, self.source)
+				self._load(pack(read_source(self.source)))
+				return
+		with open(self.path, "rb") as f:
+			if mmap is None:
+				self._load(f.read())
+				return
+			try:
+				buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (EnvironmentError, ValueError):
+				buf = f.read()
+		self._load(buf)
+
+	def _load(self, buf):
+		magic, version, count, digest = HEADER.unpack_from(buf, 0)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("{} is not a word store".format(self.path))
+		self._count = count
+		self._buf = buf
+
+	def _get_buf(self):
+		if self._buf is None:
+			self._open()
+		return self._buf
+
+	def __len__(self):
+		self._get_buf()
+		return self._count
+
+	def get(self, index):
+		"""Return the word at a 0-based index"""
+		buf = self._get_buf()
+		if not 0 <= index < self._count:
+			raise IndexError(index)
+		base = HEADER.size + OFFSET.size * index
+		start = OFFSET.unpack_from(buf, base)[0]
+		end = OFFSET.unpack_from(buf, base + OFFSET.size)[0]
+		blob = HEADER.size + OFFSET.size * (self._count + 1)
+		word = buf[blob + start:blob + end]
+		if not isinstance(word, str):
+			word = word.decode("utf-8")
+		return word
+
+	def random(self):
+		"""Return a uniformly chosen word"""
+		return self.get(randrange(len(self)))
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self.get(index)
+
+
+def main(args):
+	check = "--check" in args
+	args = [arg for arg in args if arg != "--check"]
+	if len(args) != 2:
+		sys.exit("usage: python wordstore.py [--check] <names.txt> <names.bin>")
+	source, target = args
+	if is_current(source, target):
+		print("{} is up to date".format(target))
+	elif check:
+		sys.exit("{} is stale. Run: python wordstore.py {} {}".format(target, source, target))
+	else:
+		build(source, target)
+		print("Built {}".format(target))
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])